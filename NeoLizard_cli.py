@@ -10,11 +10,15 @@ from lib.m2a import MAFtoAVInputConverter
 from lib.annovar_functions import AnnovarPipeline
 from lib.cropping_flanks import CroppingFlanksPipeline
 from lib.MHCflurry_prediction import MHCflurryPipeline
+from lib.proteome_index import ProteomeIndex
 from lib.lizard import print_lizard
 from lib.cutadapt import CutadaptPipeline
 from lib.data_gathering import PipelineData
 from lib.HLA import HLAPipeline
 from lib.database_operations import DatabaseOperations
+from lib.incremental import IncrementalManifest
+from lib.fasta_index import FastaIndex
+from lib.coding_change import CodingChangeEngine
 
 
 def main():
@@ -35,11 +39,26 @@ def main():
         logging.error("Invalid input paths. Aborting!")
         return
 
-    command_runner = CommandRunner()
+    # External tools are scheduled within the CPU budget, at most annovar_workers perl processes at once
+    # Their full output is kept per command in /logs
+    command_runner = CommandRunner(
+        args.cpus, {"perl": args.annovar_workers}, os.path.join(args.output, "logs")
+    )
 
     pipeline_data = PipelineData(pathing)
     HLA_pipeline = HLAPipeline(pathing, command_runner)
 
+    manifest = None
+    protein_changes = None  # {sample: [ProteinChange,...]} of the native coding_change engine
+    if args.incremental:
+        # Only new or changed samples are pushed through every step
+        manifest = IncrementalManifest(pathing)
+        pathing.sample_filter = manifest.changed_samples()
+        if not pathing.sample_filter:
+            logging.info("No new or changed samples, nothing to do.")
+            manifest.save()  # Keeps the refreshed file stamps, touched files aren't hashed again
+            return
+
     for arg, value in vars(args).items():
         if arg == "qc" and value == True:
             # perform qc
@@ -54,70 +73,114 @@ def main():
             )
 
         if arg == "cmd" and value != None:
-            # Perform custom command
-            output_folder = pathing.output_subfolder(
-                value[0][0]
-            )  # Cmd is a list of lists. Every list contains the requested string.
-            command_runner.configure_command(
-                pathing.input_path, output_folder, value[0]
+            # Perform custom command, its output folder is named after the module and becomes the new input
+            output_folder = pathing.output_subfolder(value.split(" ")[0])
+            command = command_runner.configure_command(
+                pathing.input_path, output_folder, value
             )
-            pathing.update_input_input(output_folder)
-            args.cmd[0].pop(0)
+            try:
+                command_runner.submit(command, label=value).result()
+                pathing.update_input(output_folder)
+            except Exception as e:
+                logging.error(f"Error occurred while running custom command: {e}")
 
         if arg == "m2a" and value == True:
+            # Perform MAF to AVInput conversion, reading every MAF once:
+            # sample barcodes (HLA_IDs) and sample names and mutation names (filename to "." and filename to ".  + lineX") are gathered in the same pass
+            m2a_pipeline = MAFtoAVInputConverter(
+                pathing, workers=args.m2a_workers, split_samples=args.m2a_split_samples
+            )
+            m2a_pipeline.run_pipeline(pipeline_data)
+            if manifest is not None:
+                # Split mode: the per-barcode outputs are tracked as outputs of their cohort MAF
+                manifest.add_derived_samples(m2a_pipeline.split_sources)
+
             if args.TCGA_alleles:
-                # Gather HLA alleles from maf files
-                pipeline_data.link_HLA_ID_TCGA_to_MAF_samples()
+                # Link HLA alleles to the gathered barcodes
                 # Temp custom source...
                 HLA_dict = HLA_pipeline.process_TCGA_HLA(
                     custom_source="./resources/panCancer_hla.tsv"
                 )
                 pipeline_data.link_HLA_TCGA_to_samples(HLA_dict)
-            # Perform MAF to AVInput conversion
-            m2a_pipeline = MAFtoAVInputConverter(pathing)
-            m2a_pipeline.run_pipeline()
-
-            # Gather sample names and mutation names here (filename to "." and filename to ".  + lineX")
-            pipeline_data.link_samples_to_mutation_from_avinput()
+            pipeline_data.save()
 
         if arg == "annovar_annotate_variation" and value == True:
             # Perform annovar_annotate
             annovar_pipeline = AnnovarPipeline(pathing, command_runner)
             annovar_pipeline.run_annotate_variation_pipeline(
-                args.annovar_annotate_variation_commands
+                args.annovar_annotate_variation_commands, args.annovar_batch
             )
 
         if arg == "annovar_coding_change" and value == True:
-            # Perform annovar_coding change
-            annovar_pipeline = AnnovarPipeline(pathing, command_runner)
-            annovar_pipeline.run_coding_change_pipeline(
-                args.annovar_coding_change_commands
-            )
+            if args.native_coding_change:
+                # Translate the variants in memory, the protein changes are passed to cropping directly
+                # (the fastas are written and indexed as well, like coding_change.pl)
+                coding_change_engine = CodingChangeEngine.from_commands(
+                    args.refgene, args.refgene_mrna, args.annovar_coding_change_commands
+                )
+                protein_changes = coding_change_engine.run_pipeline(pathing)
+                coding_change_engine.close()
+
+                # Link mutations to transcripts
+                pipeline_data.link_mutation_to_protein_changes(protein_changes)
+            else:
+                # Perform annovar_coding change
+                annovar_pipeline = AnnovarPipeline(pathing, command_runner)
+                annovar_pipeline.run_coding_change_pipeline(
+                    args.annovar_coding_change_commands
+                )
 
-            # Link mutations to transcripts
-            pipeline_data.link_mutation_to_transcripts()
+                # Link mutations to transcripts
+                pipeline_data.link_mutation_to_transcripts(FastaIndex(pathing.output_path))
 
             # Link transcripts to HLA_alleles
             if args.TCGA_alleles:
                 pipeline_data.link_transcript_to_TCGA_HLA_alleles()
+            pipeline_data.save()
 
         if arg == "mhcflurry" and value == True:
             # Perform MHCflurry binding affinity prediction. Add_flanks and alleles will be used in pipeline.
-            cropping_flanks_pipeline = CroppingFlanksPipeline(pathing)
-            mhcflurry_pipeline = MHCflurryPipeline(pathing)
+            cropping_flanks_pipeline = CroppingFlanksPipeline(
+                pathing, args.cropping_workers, FastaIndex(pathing.output_path)
+            )
+            proteome_index = None
+            if args.filter_self_peptides:
+                proteome_index = ProteomeIndex(args.refgene, args.refgene_mrna)
+            mhcflurry_pipeline = MHCflurryPipeline(
+                pathing,
+                args.mhcflurry_batch_size,
+                args.mhcflurry_chunk_size,
+                args.mhcflurry_workers,
+                args.mhcflurry_cache,
+                args.mhcflurry_cache_size,
+                proteome_index,
+                args.cascade_affinity,
+                args.cascade_percentile,
+            )
 
             flank_length = min(args.peptide_lengths) - 1
-            sequences, flanks = cropping_flanks_pipeline.cropping_flanks_pipeline_run(
-                flank_length
-            )
+            wildtypes = None
+            if args.wildtype:
+                sequences, flanks, wildtypes = cropping_flanks_pipeline.cropping_flanks_pipeline_run(
+                    flank_length, wildtype=True, protein_changes=protein_changes
+                )
+            else:
+                sequences, flanks = cropping_flanks_pipeline.cropping_flanks_pipeline_run(
+                    flank_length, protein_changes=protein_changes
+                )
 
             if args.TCGA_alleles:
                 alleles = pipeline_data.transcripts_alleles
             else:
                 alleles = args.custom_alleles
+            if manifest is not None:
+                manifest.stash_predictions()
             mhcflurry_pipeline.run_mhcflurry_pipeline(
-                sequences, flanks, args.peptide_lengths, args.add_flanks, alleles
+                sequences, flanks, args.peptide_lengths, args.add_flanks, alleles, wildtypes
             )
+            if manifest is not None:
+                # Merge the new predictions into the existing ones
+                manifest.merge_predictions()
         if arg == "store_db" and value == True:
             # Add data to PostgreSQL database.
             database_operations = DatabaseOperations(
@@ -130,6 +193,11 @@ def main():
             )
             database_operations.run_add_data_pipeline()
 
+    command_runner.shutdown()
+
+    if manifest is not None:
+        manifest.save()
+
 
 if __name__ == "__main__":
     main()
@@ -13,6 +13,7 @@ from lib.qc import QCPipeline
 from lib.m2a import MAFtoAVInputConverter
 from lib.annovar_functions import AnnovarPipeline
 from lib.cropping_flanks import CroppingFlanksPipeline
+from lib.fasta_index import FastaIndex
 from lib.MHCflurry_prediction import MHCflurryPipeline
 from lib.lizard import print_lizard
 from lib.cutadapt import CutadaptPipeline
@@ -217,7 +218,7 @@ def execute_cli(args):
         return
 
     # Initiate other objects
-    command_runner = CommandRunner()
+    command_runner = CommandRunner(log_dir=os.path.join(args["output"], "logs"))
     pipeline_data = PipelineData(pathing)
     HLA_pipeline = HLAPipeline(pathing, command_runner)
 
@@ -239,15 +240,15 @@ def execute_cli(args):
     if args["m2a"]:
         with st.spinner("Converting MAF to AVINPUT..."):
             try:
+                # Barcodes and mutations are gathered while converting
+                m2a_pipeline = MAFtoAVInputConverter(pathing)
+                m2a_pipeline.run_pipeline(pipeline_data)
                 if args["TCGA_alleles"]:
-                    pipeline_data.link_HLA_ID_TCGA_to_MAF_samples()
                     HLA_dict = HLA_pipeline.process_TCGA_HLA(
                         custom_source="./resources/panCancer_hla.tsv"
                     )
                     pipeline_data.link_HLA_TCGA_to_samples(HLA_dict)
-                m2a_pipeline = MAFtoAVInputConverter(pathing)
-                m2a_pipeline.run_pipeline()
-                pipeline_data.link_samples_to_mutation_from_avinput()
+                pipeline_data.save()
             except Exception as e:
                 st.write(f"in m2a: {e}")
     if args["annovar_annotate_variation"]:
@@ -267,15 +268,18 @@ def execute_cli(args):
                 annovar_pipeline.run_coding_change_pipeline(
                     args["annovar_coding_change_commands"]
                 )
-                pipeline_data.link_mutation_to_transcripts()
+                pipeline_data.link_mutation_to_transcripts(FastaIndex(pathing.output_path))
                 if args["TCGA_alleles"]:
                     pipeline_data.link_transcript_to_TCGA_HLA_alleles()
+                pipeline_data.save()
             except Exception as e:
                 st.write(f"in annovar coding change: {e}")
 
     if args["mhcflurry"]:
         with st.spinner("Running MHCflurry..."):
-            cropping_flanks_pipeline = CroppingFlanksPipeline(pathing)
+            cropping_flanks_pipeline = CroppingFlanksPipeline(
+                pathing, fasta_index=FastaIndex(pathing.output_path)
+            )
             mhcflurry_pipeline = MHCflurryPipeline(pathing)
             flank_length = min(args["peptide_lengths"]) - 1
             sequences, flanks = cropping_flanks_pipeline.cropping_flanks_pipeline_run(
@@ -1,13 +1,79 @@
 import os
+import time
+import shutil
 import logging
+import multiprocessing
+from itertools import chain, islice
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 
+from lib.prediction_cache import PredictionCache
+from lib.logger_config import configure_logger
+from lib.file_utils import mark_complete, mark_incomplete
+
 try:
+    import mhcflurry
     from mhcflurry import Class1AffinityPredictor, Class1PresentationPredictor
+    from mhcflurry.downloads import get_current_release
 except ImportError:
     logging.error("mhcflurry package not found. Please make sure it is installed.")
     raise
 
+# Every worker process splits the sequences into this many shards for load balancing
+SHARDS_PER_WORKER = 4
+# Peptides per reference proteome query of the self-peptide filter
+PROTEOME_QUERY_SIZE = 100000
+
+# Predictor of a worker process, loaded once by the pool initializer and reused for every shard
+_worker_predictor = None
+
+
+def _load_worker_predictor(logfiles: list = ()):
+    """
+    Pool initializer: logs to the log files of the parent (spawned workers don't inherit its logging configuration),
+    limits the threads per worker and loads the predictor once.
+    """
+    global _worker_predictor
+    for logfile in logfiles:
+        configure_logger(logfile)
+    os.environ.setdefault("OMP_NUM_THREADS", "1")
+    os.environ.setdefault("TF_NUM_INTRAOP_THREADS", "1")
+    os.environ.setdefault("TF_NUM_INTEROP_THREADS", "1")
+    _worker_predictor = Class1PresentationPredictor.load()
+
+
+def _predict_shard(pipeline, sequences, flanks, lengths, add_flanks, input_alleles, shard_file, offset, wildtypes=None):
+    """
+    Predicts one shard in a worker process with the predictor of that worker.
+    """
+    logging.info(f"Predicting {os.path.basename(shard_file)} ({len(sequences)} sequences) in process {os.getpid()}")
+    try:
+        pipeline.predict_to_csv(
+            _worker_predictor, sequences, flanks, lengths, add_flanks, input_alleles, shard_file, offset, wildtypes
+        )
+    except Exception:
+        logging.exception(f"Error occurred while predicting {os.path.basename(shard_file)}")
+        raise
+    if pipeline.cache is not None:
+        pipeline.cache.close()
+        return pipeline.cache.hits, pipeline.cache.misses
+    return 0, 0
+
+
+def mhcflurry_model_version() -> str:
+    """
+    Version of the MHCflurry package and downloaded models release, part of the prediction cache keys.
+    """
+    version = mhcflurry.__version__
+    try:
+        version += "/" + get_current_release()
+    except Exception:
+        pass
+    return version
+
+
 # 2 ways of doing this:
 ## 1) scan the sequence for peptides of given length(s) with good binding affinity --> no option to add flanks for improved accuracy
 ## 2) generate peptides of given length(s) in sequence and test them --> can add flanks for improved accuracy
@@ -19,31 +85,689 @@ class MHCflurryPipeline:
     Pipeline for running MHCflurry on sequences (and flanks) for MHC-binding affinity prediction.
     """
 
-    def __init__(self, path_handler):
+    # Column order of Class1PresentationPredictor.predict when flanks are given
+    PREDICTION_COLUMNS = [
+        "peptide",
+        "n_flank",
+        "c_flank",
+        "peptide_num",
+        "sample_name",
+        "affinity",
+        "best_allele",
+        "processing_score",
+        "presentation_score",
+        "presentation_percentile",
+    ]
+
+    def __init__(
+        self,
+        path_handler,
+        batch_size: int = 10000,
+        chunk_size: int = None,
+        workers: int = 1,
+        cache_path: str = None,
+        cache_size: int = 10000000,
+        proteome_index=None,
+        cascade_affinity: float = None,
+        cascade_percentile: float = None,
+    ):
         self.path_handler = path_handler
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size  # None: predict everything at once, otherwise stream chunks to the csv
+        self.workers = workers
+        self.cache = None  # Only used for peptides with flanks (add_flanks)
+        if cache_path:
+            self.cache = PredictionCache(cache_path, mhcflurry_model_version(), cache_size)
+        self.proteome_index = proteome_index  # ProteomeIndex for dropping self-peptides (add_flanks)
+        # Cascade: only peptides under one of these affinity cutoffs get presentation scores (add_flanks)
+        self.cascade_affinity = cascade_affinity  # nM
+        self.cascade_percentile = cascade_percentile  # affinity percentile
 
-    def create_peptides(self, sequences: list, flanks: list, lengths: list, input_alleles):
-        """
-        Creates peptides and flanks as a better way of doing a scan for peptides.
-        """
-        peptides, N_flanks, C_flanks, sequence_names, alleles = [], [], [], [], dict()
-        for count, value in enumerate(sequences):
-            seq = value[1]
-            name = value[0]
-            x=0
-            for l in lengths:
-                for index in range(len(seq)):
-                    if index + l <= len(seq):  # Check if slicing is possible
-                        x+=1
-                        peptides.append(seq[index : index + l])
-                        N_flanks.append(flanks[count][0] + seq[:index])
-                        C_flanks.append(seq[index:] + flanks[count][1])
-                        sequence_names.append(name)
-                        if isinstance(input_alleles,dict):
-                            alleles[name+'seq'+str(x)]=input_alleles[value[0]]
-                        else:
-                            alleles[name+'seq'+str(x)]=input_alleles
-        return peptides, N_flanks, C_flanks, sequence_names, alleles
+    def create_windows(self, sequences: list, lengths: list) -> dict:
+        """
+        Creates a compact window table of all peptides of given length(s), a better way of doing a scan for peptides.
+        Windows are NumPy arrays of sequence index, start and length over one shared sequence buffer,
+        ordered per sequence, per length and per start. Number is the window number within its sequence (starting at 1).
+        """
+        seq_lengths = np.array([len(seq) for _, seq in sequences], dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        # Amount of windows per sequence (rows) and length (columns)
+        counts = np.maximum(seq_lengths[:, None] - lengths[None, :] + 1, 0)
+        group_counts = counts.ravel()
+        sequence_counts = counts.sum(axis=1)
+        total = int(group_counts.sum())
+        window_index = np.arange(total, dtype=np.int64)
+        return {
+            "buffer": "".join(seq for _, seq in sequences),
+            "offsets": np.cumsum(seq_lengths) - seq_lengths,
+            "seq_lengths": seq_lengths,
+            "sequence": np.repeat(
+                np.arange(len(sequences), dtype=np.int32), sequence_counts
+            ),
+            "start": (
+                window_index - np.repeat(np.cumsum(group_counts) - group_counts, group_counts)
+            ).astype(np.int32),
+            "length": np.repeat(np.tile(lengths, len(sequences)), group_counts).astype(np.int16),
+            "number": (
+                window_index
+                - np.repeat(np.cumsum(sequence_counts) - sequence_counts, sequence_counts)
+                + 1
+            ).astype(np.int32),
+        }
+
+    def flank_lengths(self, predictor) -> tuple:
+        """
+        Longest N and C flank used by the processing models of the predictor.
+        Returns (None, None) if unknown, flanks are not capped then.
+        """
+        try:
+            models = predictor.processing_predictor_with_flanks.models
+            return (
+                max(model.hyperparameters["n_flank_length"] for model in models),
+                max(model.hyperparameters["c_flank_length"] for model in models),
+            )
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None, None
+
+    def window_strings(self, windows: dict, flanks: list, n_length: int = None, c_length: int = None):
+        """
+        Generator that materializes (peptide, n_flank, c_flank) window by window, flanks are capped to n_length/c_length if given.
+        The N flank ends before the peptide, the C flank starts at the peptide start (as the flanks always did).
+        """
+        buffer, offsets, seq_lengths = windows["buffer"], windows["offsets"], windows["seq_lengths"]
+        for sequence, start, length in zip(
+            windows["sequence"].tolist(), windows["start"].tolist(), windows["length"].tolist()
+        ):
+            offset = int(offsets[sequence])
+            end = offset + int(seq_lengths[sequence])
+            begin = offset + start
+            left, right = flanks[sequence]
+            if n_length is None:
+                n_flank = left + buffer[offset:begin]
+            elif start >= n_length:
+                n_flank = buffer[begin - n_length : begin]
+            else:
+                n_flank = left[max(0, len(left) - n_length + start) :] + buffer[offset:begin]
+            if c_length is None:
+                c_flank = buffer[begin:end] + right
+            else:
+                c_flank = buffer[begin : min(end, begin + c_length)]
+                c_flank += right[: c_length - len(c_flank)]
+            yield buffer[begin : begin + length], n_flank, c_flank
+
+    def materialize_windows(self, windows: dict, flanks: list, n_length: int = None, c_length: int = None) -> tuple:
+        """
+        Materializes the peptides and flanks of all windows as lists (see window_strings).
+        """
+        peptides, n_flanks, c_flanks = [], [], []
+        for peptide, n_flank, c_flank in self.window_strings(windows, flanks, n_length, c_length):
+            peptides.append(peptide)
+            n_flanks.append(n_flank)
+            c_flanks.append(c_flank)
+        return peptides, n_flanks, c_flanks
+
+    def window_units(self, windows: dict, flanks: list, sequence_genotypes: list, n_length: int = None, c_length: int = None):
+        """
+        Generator of the (peptide, n_flank, c_flank, genotype) unit of every window, materialized window by window.
+        """
+        for (peptide, n_flank, c_flank), sequence in zip(
+            self.window_strings(windows, flanks, n_length, c_length), windows["sequence"].tolist()
+        ):
+            yield peptide, n_flank, c_flank, sequence_genotypes[sequence]
+
+    def self_peptides(self, windows: dict, flanks: list) -> np.ndarray:
+        """
+        Boolean array, True for the windows whose peptide occurs in the reference proteome.
+        The peptides are materialized and queried in blocks.
+        """
+        found = np.zeros(len(windows["start"]), dtype=bool)
+        peptides = (peptide for peptide, _, _ in self.window_strings(windows, flanks, 0, 0))
+        for start in range(0, len(found), PROTEOME_QUERY_SIZE):
+            block = list(islice(peptides, PROTEOME_QUERY_SIZE))
+            found[start : start + len(block)] = self.proteome_index.contains(block)
+        return found
+
+    def wildtype_windows(self, windows: dict, sequences: list, wildtypes: list) -> tuple:
+        """
+        Window table over the wildtype sequences, restricted to the windows whose sequence has an aligned wildtype
+        (same length, so every window has the same coordinates). Returns (window indices, wildtype windows).
+        """
+        aligned = np.array(
+            [wildtype is not None and len(wildtype) == len(seq) for (_, seq), wildtype in zip(sequences, wildtypes)],
+            dtype=bool,
+        )
+        rows = np.flatnonzero(aligned[windows["sequence"]])
+        wildtype_windows = {
+            "buffer": "".join(
+                wildtype if is_aligned else seq
+                for (_, seq), wildtype, is_aligned in zip(sequences, wildtypes, aligned)
+            ),
+            "offsets": windows["offsets"],
+            "seq_lengths": windows["seq_lengths"],
+        }
+        for column in ("sequence", "start", "length", "number"):
+            wildtype_windows[column] = windows[column][rows]
+        return rows, wildtype_windows
+
+    def predict_windows(
+        self,
+        predictor,
+        sequences: list,
+        flanks: list,
+        lengths: list,
+        input_alleles,
+        offset: int = 0,
+        wildtypes: list = None,
+    ) -> pd.DataFrame:
+        """
+        Predicts all peptides of given length(s) in the sequences with their flanks.
+        Every peptide gets a sample name (sequence name + 'seq' + number) and the genotype (tuple of alleles) of its sequence.
+        If a proteome index is used, peptides found in the reference proteome are dropped before prediction.
+        If wildtypes (cropped wildtype sequence or None per sequence) are given, the wildtype counterpart of every
+        peptide is predicted in the same batches and the wt_affinity and agretopicity (affinity / wt_affinity) columns are added.
+        peptide_num is the window index (plus offset), also for the remaining peptides.
+        Only the window table is kept for all peptides, the peptide and flank strings are materialized window by window
+        and only kept once per unique unit.
+        """
+        windows = self.create_windows(sequences, lengths)
+        kept = np.arange(len(windows["start"]))
+        if self.proteome_index is not None:
+            found = self.self_peptides(windows, flanks)
+            kept = np.flatnonzero(~found)
+            logging.info(
+                f"Self-peptide filter: {len(found) - len(kept)} out of {len(found)} peptides found in the reference proteome."
+            )
+            for column in ("sequence", "start", "length", "number"):
+                windows[column] = windows[column][kept]
+
+        if isinstance(input_alleles, Mapping):
+            sequence_genotypes = [tuple(input_alleles[name]) for name, _ in sequences]
+        else:
+            sequence_genotypes = [tuple(input_alleles)] * len(sequences)
+        sample_names = [
+            sequences[sequence][0] + "seq" + str(number)
+            for sequence, number in zip(windows["sequence"].tolist(), windows["number"].tolist())
+        ]
+        if wildtypes is None:
+            inverse, units = self.plan_units(
+                self.window_units(windows, flanks, sequence_genotypes, *self.flank_lengths(predictor)),
+                len(sample_names),
+            )
+            predictions = self.predict_units(predictor, units, inverse, sample_names)
+        else:
+            predictions = self.predict_with_wildtypes(
+                predictor, windows, sequences, flanks, wildtypes, sample_names, sequence_genotypes
+            )
+        predictions["peptide_num"] = offset + kept[predictions["peptide_num"].to_numpy()]
+        return predictions
+
+    def predict_with_wildtypes(
+        self,
+        predictor,
+        windows: dict,
+        sequences: list,
+        flanks: list,
+        wildtypes: list,
+        sample_names: list,
+        sequence_genotypes: list,
+    ) -> pd.DataFrame:
+        """
+        Appends the wildtype counterparts of the peptides to the same prediction call, so they share the
+        batching, unit dedup and cache (a wildtype equal to another peptide costs nothing extra).
+        The wildtype rows follow their peptide through the cascade and are split off into the wt_affinity column.
+        """
+        total = len(sample_names)
+        rows, wildtype_windows = self.wildtype_windows(windows, sequences, wildtypes)
+        logging.info(f"Adding {len(rows)} wildtype peptides to the prediction.")
+        companions = np.concatenate((np.full(total, -1, dtype=np.int64), rows))
+        flank_lengths = self.flank_lengths(predictor)
+        # The flanks outside the cropped sequence are the same for a SNP and its wildtype
+        inverse, units = self.plan_units(
+            chain(
+                self.window_units(windows, flanks, sequence_genotypes, *flank_lengths),
+                self.window_units(wildtype_windows, flanks, sequence_genotypes, *flank_lengths),
+            ),
+            total + len(rows),
+        )
+        predictions = self.predict_units(
+            predictor,
+            units,
+            inverse,
+            sample_names + [sample_names[i] for i in rows.tolist()],
+            companions=companions,
+        )
+
+        peptide_num = predictions["peptide_num"].to_numpy()
+        is_wildtype = peptide_num >= total
+        wt_affinity = np.full(total, np.nan)
+        wt_affinity[rows[peptide_num[is_wildtype] - total]] = predictions["affinity"].to_numpy()[is_wildtype]
+        predictions = predictions[~is_wildtype].reset_index(drop=True)
+        predictions["wt_affinity"] = wt_affinity[predictions["peptide_num"].to_numpy()]
+        predictions["agretopicity"] = predictions["affinity"] / predictions["wt_affinity"]
+        return predictions
+
+    def count_peptides(self, sequence: str, lengths: list) -> int:
+        """
+        Amount of peptides of given length(s) in a sequence.
+        """
+        return sum(max(0, len(sequence) - l + 1) for l in lengths)
+
+    def sequence_chunks(self, sequences: list, lengths: list, chunk_size: int):
+        """
+        Yields (start, end) ranges of whole sequences that together hold about chunk_size peptides.
+        """
+        start = 0
+        while start < len(sequences):
+            end, amount = start, 0
+            while end < len(sequences) and (amount == 0 or amount < chunk_size):
+                amount += self.count_peptides(sequences[end][1], lengths)
+                end += 1
+            yield start, end
+            start = end
+
+    def plan_units(self, units, total: int) -> tuple:
+        """
+        Collapses the (peptide, n_flank, c_flank, genotype) units of the total peptides (an iterable, e.g. window_units)
+        to the unique units, only their strings are kept.
+        Returns the unit index of every peptide and the list of unique units.
+        """
+        unique = {}
+        inverse = np.empty(total, dtype=np.int64)
+        for index, unit in enumerate(units):
+            inverse[index] = unique.setdefault(unit, len(unique))
+        return inverse, list(unique)
+
+    def group_by_genotype(self, genotypes: list) -> dict:
+        """
+        Groups the peptide indices per genotype, every group can be sent to the predictor in large batches.
+        """
+        groups = {}
+        for index, genotype in enumerate(genotypes):
+            groups.setdefault(genotype, []).append(index)
+        return {genotype: np.asarray(indices) for genotype, indices in groups.items()}
+
+    def predict_rows(
+        self,
+        predictor,
+        rows: np.ndarray,
+        peptides: list,
+        n_flanks: list,
+        c_flanks: list,
+        genotype: tuple,
+        results: dict,
+    ):
+        """
+        Predicts one batch of rows (peptide indices) with the same genotype into the preallocated results.
+        If a cache is used, only the rows missing from the cache reach the predictor.
+        """
+        batch_peptides = [peptides[i] for i in rows]
+        batch_n_flanks = [n_flanks[i] for i in rows]
+        batch_c_flanks = [c_flanks[i] for i in rows]
+
+        if self.cache is not None:
+            keys = self.cache.keys(batch_peptides, batch_n_flanks, batch_c_flanks, genotype)
+            cached = self.cache.get(keys)
+            hit = np.array([key in cached for key in keys], dtype=bool)
+            if hit.any():
+                cached_rows = [cached[key] for key in keys if key in cached]
+                for n, column in enumerate(PredictionCache.COLUMNS):
+                    results[column][rows[hit]] = np.array(
+                        [row[n] for row in cached_rows], dtype=results[column].dtype
+                    )
+            if hit.all():
+                return
+            missing = np.flatnonzero(~hit)
+            rows = rows[missing]
+            keys = [keys[i] for i in missing]
+            batch_peptides = [batch_peptides[i] for i in missing]
+            batch_n_flanks = [batch_n_flanks[i] for i in missing]
+            batch_c_flanks = [batch_c_flanks[i] for i in missing]
+
+        prediction = predictor.predict(
+            peptides=batch_peptides,
+            n_flanks=batch_n_flanks,
+            c_flanks=batch_c_flanks,
+            alleles=list(genotype),
+            verbose=0,
+        ).sort_values("peptide_num")
+        if len(prediction) != len(rows):
+            raise ValueError(
+                f"MHCflurry returned {len(prediction)} predictions for {len(rows)} peptides."
+            )
+        for column in results:
+            results[column][rows] = prediction[column].to_numpy()
+
+        if self.cache is not None:
+            # Store the values as they are in the results, cached rows come out identical to fresh predictions
+            self.cache.put(
+                keys,
+                zip(*[results[column][rows].tolist() for column in PredictionCache.COLUMNS]),
+            )
+
+    def predict_batched(
+        self,
+        predictor,
+        peptides: list,
+        n_flanks: list,
+        c_flanks: list,
+        sample_names: list,
+        genotypes: list,
+        offset: int = 0,
+        companions: np.ndarray = None,
+    ) -> pd.DataFrame:
+        """
+        Predicts all peptides with flanks in vectorized batches, grouped by genotype (see predict_units).
+        """
+        inverse, units = self.plan_units(zip(peptides, n_flanks, c_flanks, genotypes), len(peptides))
+        return self.predict_units(predictor, units, inverse, sample_names, offset, companions)
+
+    def predict_units(
+        self,
+        predictor,
+        units: list,
+        inverse: np.ndarray,
+        sample_names: list,
+        offset: int = 0,
+        companions: np.ndarray = None,
+    ) -> pd.DataFrame:
+        """
+        Predicts the unique peptide/flanks/genotype units (plan_units) once and fans them out to all their peptides.
+        Results are gathered into one preallocated frame in the original peptide order.
+        Offset is added to peptide_num when predicting a chunk of a larger run.
+        Companions (index of the lead peptide, -1 for none) are kept or pruned by the cascade together with their lead.
+        """
+        total = len(inverse)
+        unit_peptides = [unit[0] for unit in units]
+        unit_n_flanks = [unit[1] for unit in units]
+        unit_c_flanks = [unit[2] for unit in units]
+        unit_genotypes = [unit[3] for unit in units]
+
+        numeric_columns = [
+            "affinity",
+            "processing_score",
+            "presentation_score",
+            "presentation_percentile",
+        ]
+        unit_results = {column: np.empty(len(units), dtype=np.float64) for column in numeric_columns}
+        unit_results["best_allele"] = np.empty(len(units), dtype=object)
+
+        unit_kept = np.ones(len(units), dtype=bool)
+        cascade = self.cascade_affinity is not None or self.cascade_percentile is not None
+        if cascade:
+            unit_kept = self.affinity_prefilter(predictor, unit_peptides, unit_genotypes)
+        row_kept = unit_kept[inverse]
+        if companions is not None:
+            follows = companions >= 0
+            row_kept[follows] = row_kept[companions[follows]]
+            unit_kept = np.zeros(len(units), dtype=bool)
+            unit_kept[inverse[row_kept]] = True
+
+        groups = self.group_by_genotype(unit_genotypes)
+        logging.info(
+            f"Predicting {int(unit_kept.sum())} unique peptide/flanks/genotype units for {total} peptides "
+            f"(dedup ratio {total / max(len(units), 1):.2f}) for {len(groups)} genotypes in batches of {self.batch_size}..."
+        )
+        start_time = time.perf_counter()
+        for genotype, indices in groups.items():
+            indices = indices[unit_kept[indices]]
+            for start in range(0, len(indices), self.batch_size):
+                self.predict_rows(
+                    predictor,
+                    indices[start : start + self.batch_size],
+                    unit_peptides,
+                    unit_n_flanks,
+                    unit_c_flanks,
+                    genotype,
+                    unit_results,
+                )
+        if cascade:
+            # Logged even when nothing was pruned, the stage timings show whether the cascade pays off
+            logging.info(
+                f"Cascade stage 2 (presentation): {int(unit_kept.sum())} out of {len(units)} units scored "
+                f"in {time.perf_counter() - start_time:.1f}s."
+            )
+
+        # Fan the unit predictions back out to every (remaining) peptide
+        rows = np.flatnonzero(row_kept)
+        if len(rows) < total:
+            sample_names = [sample_names[i] for i in rows]
+        unit_rows = inverse[rows]
+        results = {column: values[unit_rows] for column, values in unit_results.items()}
+
+        predictions = pd.DataFrame(
+            {
+                "peptide": np.array(unit_peptides, dtype=object)[unit_rows],
+                "n_flank": np.array(unit_n_flanks, dtype=object)[unit_rows],
+                "c_flank": np.array(unit_c_flanks, dtype=object)[unit_rows],
+                "peptide_num": offset + rows,
+                "sample_name": sample_names,
+                **results,
+            },
+            columns=self.PREDICTION_COLUMNS,
+        )
+        return predictions
+
+    def affinity_prefilter(self, predictor, peptides: list, genotypes: list) -> np.ndarray:
+        """
+        Cascade stage one: scores every unique peptide/genotype pair with the affinity predictor only.
+        Returns a mask of the units that pass the affinity (nM) or affinity percentile cutoff.
+        """
+        start_time = time.perf_counter()
+        pairs = {}
+        pair_index = np.array(
+            [pairs.setdefault(pair, len(pairs)) for pair in zip(peptides, genotypes)],
+            dtype=np.int64,
+        )
+        pair_list = list(pairs)
+        affinity = np.empty(len(pair_list), dtype=np.float64)
+        percentile = np.empty(len(pair_list), dtype=np.float64)
+        for genotype, indices in self.group_by_genotype([pair[1] for pair in pair_list]).items():
+            for start in range(0, len(indices), self.batch_size):
+                rows = indices[start : start + self.batch_size]
+                prediction = predictor.predict_affinity(
+                    peptides=[pair_list[i][0] for i in rows],
+                    alleles={"sample1": list(genotype)},
+                    include_affinity_percentile=True,
+                    verbose=0,
+                ).sort_values("peptide_num")
+                affinity[rows] = prediction["affinity"].to_numpy()
+                percentile[rows] = prediction["affinity_percentile"].to_numpy()
+
+        passed = np.zeros(len(pair_list), dtype=bool)
+        if self.cascade_affinity is not None:
+            passed |= affinity <= self.cascade_affinity
+        if self.cascade_percentile is not None:
+            passed |= percentile <= self.cascade_percentile
+        kept = passed[pair_index]
+        logging.info(
+            f"Cascade stage 1 (affinity): {len(pair_list)} peptide/genotype pairs scored in {time.perf_counter() - start_time:.1f}s, "
+            f"{len(kept) - int(kept.sum())} out of {len(kept)} units pruned."
+        )
+        return kept
+
+    def add_sequence_name(self, predictions: pd.DataFrame) -> pd.DataFrame:
+        """
+        Creates the sequence_name column (first column) for further visualisation.
+        """
+        new_header = 'sequence_name'
+        predictions[new_header] = predictions['sample_name']
+        return predictions[[new_header] + [col for col in predictions.columns if col != new_header]]
+
+    def predict_sequences(self, predictor, sequences: list, lengths: list, input_alleles) -> pd.DataFrame:
+        """
+        Scans the sequences for peptides of given length(s) with MHCflurry (no flanks).
+        """
+        if isinstance(input_alleles, Mapping): # Check if TCGA alleles were given
+            alleles = [input_alleles[i[0]] for i in sequences]
+        else: # or custom alleles (list)
+            alleles = input_alleles * len(sequences)
+        sequences = {i[0]: i[1] for i in sequences}
+        return predictor.predict_sequences(
+            sequences, alleles=alleles, peptide_lengths=lengths
+        )
+
+    def append_predictions(self, predictions: pd.DataFrame, outfile: str, header: bool):
+        """
+        Appends a chunk of predictions to the csv and flushes it to disk, finished chunks survive an interruption.
+        """
+        with open(outfile, "a") as f:
+            f.write(predictions.to_csv(index=False, header=header))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def stream_predictions(
+        self,
+        predictor,
+        sequences: list,
+        flanks: list,
+        lengths: list,
+        add_flanks: bool,
+        input_alleles,
+        outfile: str,
+        offset: int = 0,
+        wildtypes: list = None,
+    ):
+        """
+        Predicts the sequences chunk by chunk and appends every chunk to the outfile.
+        Peak memory depends on the chunk size instead of the amount of sequences.
+        """
+        open(outfile, "w").close()
+        for chunk, (start, end) in enumerate(
+            self.sequence_chunks(sequences, lengths, self.chunk_size)
+        ):
+            if add_flanks:
+                predictions = self.add_sequence_name(
+                    self.predict_windows(
+                        predictor,
+                        sequences[start:end],
+                        flanks[start:end],
+                        lengths,
+                        input_alleles,
+                        offset=offset,
+                        wildtypes=wildtypes[start:end] if wildtypes is not None else None,
+                    )
+                )
+            else:
+                predictions = self.predict_sequences(
+                    predictor, sequences[start:end], lengths, input_alleles
+                )
+            self.append_predictions(predictions, outfile, header=chunk == 0)
+            offset += sum(self.count_peptides(seq, lengths) for _, seq in sequences[start:end])
+            logging.info(
+                f"Chunk {chunk + 1} written: {end} out of {len(sequences)} sequences predicted."
+            )
+
+    def predict_to_csv(
+        self,
+        predictor,
+        sequences: list,
+        flanks: list,
+        lengths: list,
+        add_flanks: bool,
+        input_alleles,
+        outfile: str,
+        offset: int = 0,
+        wildtypes: list = None,
+    ):
+        """
+        Predicts the sequences (streamed in chunks if a chunk size is set) and writes them to the outfile.
+        """
+        if self.chunk_size:
+            self.stream_predictions(
+                predictor, sequences, flanks, lengths, add_flanks, input_alleles, outfile, offset, wildtypes
+            )
+        elif add_flanks:  # Decides if method 1 or 2
+            # Run predict for all peptides in batches per genotype
+            predictions = self.predict_windows(
+                predictor, sequences, flanks, lengths, input_alleles, offset, wildtypes
+            )
+            self.add_sequence_name(predictions).to_csv(outfile, index=False)
+        else:
+            self.predict_sequences(
+                predictor, sequences, lengths, input_alleles
+            ).to_csv(outfile, index=False)
+
+    def run_sharded(
+        self,
+        sequences: list,
+        flanks: list,
+        lengths: list,
+        add_flanks: bool,
+        input_alleles,
+        outfile: str,
+        wildtypes: list = None,
+    ):
+        """
+        Shards the sequences over a pool of worker processes that each load the predictor once.
+        Every shard is written to its own csv in a scratch dir, the shards are merged in order into the outfile.
+        """
+        shards_path = self.path_handler.output_subfolder("mhcflurry_shards")
+        shard_size = max(
+            1,
+            sum(self.count_peptides(seq, lengths) for _, seq in sequences)
+            // (self.workers * SHARDS_PER_WORKER),
+        )
+        jobs, offset = [], 0
+        for number, (start, end) in enumerate(
+            self.sequence_chunks(sequences, lengths, shard_size)
+        ):
+            shard_sequences = sequences[start:end]
+            if isinstance(input_alleles, Mapping):
+                shard_alleles = {name: input_alleles[name] for name, _ in shard_sequences}
+            else:
+                shard_alleles = input_alleles
+            shard_file = os.path.join(shards_path, f"shard_{number:05d}.csv")
+            shard_wildtypes = wildtypes[start:end] if wildtypes is not None else None
+            jobs.append(
+                (shard_sequences, flanks[start:end], lengths, add_flanks, shard_alleles, shard_file, offset, shard_wildtypes)
+            )
+            offset += sum(self.count_peptides(seq, lengths) for _, seq in shard_sequences)
+
+        try:
+            if self.proteome_index is not None:
+                # Built (if missing or outdated) by the parent only, the workers just map it
+                self.proteome_index.load()
+            logging.info(f"Predicting {len(jobs)} shards with {self.workers} workers...")
+            with ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_load_worker_predictor,
+                initargs=(self.log_files(),),
+            ) as executor:
+                futures = [executor.submit(_predict_shard, self, *job) for job in jobs]
+                for number, future in enumerate(futures):
+                    hits, misses = future.result()  # Raises the error of a failed shard
+                    if self.cache is not None:
+                        self.cache.hits += hits
+                        self.cache.misses += misses
+                    logging.info(f"Shard {number + 1} out of {len(jobs)} predicted.")
+
+            self.merge_shards([job[5] for job in jobs], outfile)
+        finally:
+            # Scratch dir, also removed after a failed shard
+            shutil.rmtree(shards_path, ignore_errors=True)
+
+    def log_files(self) -> list:
+        """
+        Files the root logger writes to (configure_logger), passed to the worker processes.
+        """
+        return [
+            handler.baseFilename
+            for handler in logging.getLogger().handlers
+            if isinstance(handler, logging.FileHandler)
+        ]
+
+    def merge_shards(self, shard_files: list, outfile: str):
+        """
+        Concatenates the shard csv files in shard order, keeping only the first header.
+        """
+        with open(outfile, "w") as out:
+            for number, shard_file in enumerate(shard_files):
+                with open(shard_file, "r") as f:
+                    header = f.readline()
+                    if number == 0:
+                        out.write(header)
+                    shutil.copyfileobj(f, out)
 
     def run_mhcflurry_pipeline(
         self,
@@ -52,51 +776,44 @@ class MHCflurryPipeline:
         lengths: list,
         add_flanks: bool,
         input_alleles,
+        wildtypes: list = None,
     ):
         """
         Runs the MHCflurry pipeline.
+        Wildtypes (cropped wildtype sequence or None per sequence) add wildtype predictions, only with add_flanks.
+        The predictions are streamed to predictions.csv, a completion marker is written once all predictions are in,
+        the rows written by a failed run are kept.
         """
+        outfile = os.path.join(self.path_handler.output_path, "predictions.csv")
+        mark_incomplete(outfile)
         try:
             logging.info("Running MHCflurry pipeline...")
-            predictor = Class1PresentationPredictor.load()
-            alleles=[]
-            outfile = os.path.join(self.path_handler.output_path, "predictions.csv")
+            if wildtypes is not None and not add_flanks:
+                logging.warning("Wildtype predictions are only available with add_flanks, ignoring wildtypes.")
+                wildtypes = None
 
-            if add_flanks:  # Decides if method 1 or 2
-                peptides, N_flanks, C_flanks, sequence_names, alleles = self.create_peptides(
-                    sequences, flanks, lengths, input_alleles
+            if self.workers > 1:
+                self.run_sharded(
+                    sequences, flanks, lengths, add_flanks, input_alleles, outfile, wildtypes
                 )
-                # Run predict for every peptide
-                predictions=pd.DataFrame()
-                for x in range(len(peptides)):
-                    onepairdict=dict()
-                    onepairdict[list(alleles.keys())[x]]=alleles[list(alleles.keys())[x]]
-                    prediction = predictor.predict(
-                        peptides=[peptides[x]],
-                        n_flanks=[N_flanks[x]],
-                        c_flanks=[C_flanks[x]],
-                        alleles=onepairdict,
-                    )
-                    predictions = predictions.append(prediction, ignore_index=True)
-                # create sequence_name column for further visualisation
-                new_header = 'sequence_name'
-                predictions[new_header] = predictions['sample_name']
-                predictions = predictions[[new_header] + [col for col in predictions.columns if col != new_header]]
-                predictions.to_csv(outfile, index=False)
             else:
-                if isinstance(input_alleles,dict): # Check if TCGA alleles were given
-                    alleles = [input_alleles[i[0]] for i in sequences]
-                else: # or custom alleles (list)
-                    alleles = input_alleles * len(sequences)
-                sequences = {i[0]: i[1] for i in sequences}
-                predictor.predict_sequences(
-                    sequences, alleles=alleles, peptide_lengths=lengths
-                ).to_csv(outfile, index=False)
+                predictor = Class1PresentationPredictor.load()
+                self.predict_to_csv(
+                    predictor, sequences, flanks, lengths, add_flanks, input_alleles, outfile, wildtypes=wildtypes
+                )
+            mark_complete(outfile)
+            if self.cache is not None:
+                logging.info(
+                    f"Prediction cache: {self.cache.hits} hits, {self.cache.misses} misses."
+                )
+                self.cache.close()
             self.path_handler.update_input(outfile)
             logging.info("Predictions completed.")
             self.path_handler.update_input(outfile)
         except Exception as e:
             logging.exception(f"An error occurred: {str(e)}")
+            if os.path.exists(outfile):
+                logging.warning(f"Predictions are incomplete, the predictions written so far are kept in {outfile}")
 
     # The binding affinity predictions are given as affinities (KD) in nM in the mhcflurry_affinity column. Lower values indicate stronger binders. A commonly-used threshold for peptides with a reasonable chance of being immunogenic is 500 nM.
     # The mhcflurry_affinity_percentile gives the percentile of the affinity prediction among a large number of random peptides tested on that allele (range 0 - 100). Lower is stronger. Two percent is a commonly-used threshold.
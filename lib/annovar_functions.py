@@ -1,5 +1,15 @@
 import os
+import re
+import shutil
 import logging
+from collections import OrderedDict
+
+from lib.fasta_index import FastaIndex
+
+# Tag appended to every line of the batched avinput: NLZ<file number>:<line number in the file>
+BATCH_TAG = re.compile(r"\tNLZ(\d+):(\d+)$")
+# annotate_variation output files that are split per sample, the exonic one starts with the input line number
+BATCH_OUTPUTS = (".variant_function", ".exonic_variant_function", ".invalid_input")
 
 
 class AnnovarPipeline:
@@ -14,10 +24,26 @@ class AnnovarPipeline:
         self.path_handler = path_handler
         self.command_runner = command_runner
 
-    def run_annotate_variation_pipeline(self, commands: str):
+    def run_file_commands(self, jobs: list) -> int:
+        """
+        Submits the commands of the files, (file, command) jobs, to the command_runner scheduler
+        (concurrent perl processes are capped by its perl limit), returns the amount of succeeded files.
+        """
+        futures = {}
+        for file, command in jobs:
+            logging.info(f"Starting annotation of {file[1]}")
+            futures[file[1]] = self.command_runner.submit(command, label=file[1])
+        succeeded, failed = self.command_runner.gather(futures)
+        for name in succeeded:
+            logging.info(f"Finished annotation of {name}")
+        return len(succeeded)
+
+    def run_annotate_variation_pipeline(self, commands: str, batched: bool = False):
         """
         Runs the annotate_variation perl script of Annovar on avinput/vcf files.
-        Creates an output folder "annotations" with annotated files.
+        Creates an output folder "annotations" with annotated files, the files are annotated concurrently by the command_runner.
+        In batched mode annotate_variation runs once for all files (the database is loaded once),
+        the output is split into the same files as annotating every file separately.
         """
         annotated_files = 0
         # split command string into list, process.Popen needs a list
@@ -27,22 +53,26 @@ class AnnovarPipeline:
         logging.info(
             f"Processing {len(file_list)} files in {self.path_handler.input_path}"
         )
-        for file in file_list:
-            logging.info(f"Starting annotation of {file[1]}")
+        if batched:
             try:
-                outfile = os.path.join(annotations_path, file[1][:-8])
-                self.command_runner.run(
-                    ["perl", "annovar/annotate_variation.pl"]
-                    + [file[0]]
-                    + ["-out", outfile]
-                    + commands
-                )
-                annotated_files += 1
-                logging.info(f"Finished annotation of {file[1]}")
+                annotated_files = self.annotate_variation_batched(file_list, commands, annotations_path)
             except Exception as e:
-                logging.error("Error occurred while annotating file: %s", file[1])
+                logging.error("Error occurred while annotating the batched files")
                 logging.error(str(e))
                 raise
+        else:
+            annotated_files = self.run_file_commands(
+                [
+                    (
+                        file,
+                        ["perl", "annovar/annotate_variation.pl"]
+                        + [file[0]]
+                        + ["-out", os.path.join(annotations_path, file[1][:-8])]
+                        + commands,
+                    )
+                    for file in file_list
+                ]
+            )
         logging.info(
             f"Finished annotating {annotated_files} out of {len(file_list)} files."
         )
@@ -50,12 +80,90 @@ class AnnovarPipeline:
         # The /annotations dir becomes the new input dir
         self.path_handler.update_input(annotations_path)
 
+    def annotate_variation_batched(self, file_list: list, commands: list, annotations_path: str) -> int:
+        """
+        Concatenates the files into one avinput, every line tagged with its file and line number (extra last column,
+        annotate_variation copies the input line to its output), annotates it once and splits the output per file.
+        Returns the amount of annotated files.
+        """
+        batch_path = os.path.join(annotations_path, ".batch")  # hidden, not listed as input of the next step
+        os.makedirs(batch_path, exist_ok=True)
+        batch_file = os.path.join(batch_path, "batch.avinput")
+        try:
+            with open(batch_file, "w") as batch:
+                for number, file in enumerate(file_list):
+                    with open(file[0], "r") as f:
+                        batch.writelines(
+                            line.rstrip("\r\n") + f"\tNLZ{number}:{line_number}\n"
+                            for line_number, line in enumerate(f, 1)
+                        )
+            logging.info(f"Starting batched annotation of {len(file_list)} files")
+            self.command_runner.run(
+                ["perl", "annovar/annotate_variation.pl"]
+                + [batch_file]
+                + ["-out", os.path.join(batch_path, "batch")]
+                + commands
+            )
+            if not os.path.isfile(os.path.join(batch_path, "batch.variant_function")):
+                raise RuntimeError("annotate_variation produced no output for the batch")
+            outfiles = [os.path.join(annotations_path, file[1][:-8]) for file in file_list]
+            for suffix in BATCH_OUTPUTS:
+                self.split_batch_output(os.path.join(batch_path, "batch" + suffix), outfiles, suffix)
+            # One log for the whole batch
+            if os.path.isfile(os.path.join(batch_path, "batch.log")):
+                shutil.copyfile(
+                    os.path.join(batch_path, "batch.log"),
+                    os.path.join(annotations_path, "annotate_variation.batch.log"),
+                )
+            logging.info(f"Finished batched annotation of {len(file_list)} files")
+        finally:
+            shutil.rmtree(batch_path, ignore_errors=True)
+        return len(file_list)
+
+    def split_batch_output(self, batch_output: str, outfiles: list, suffix: str, max_open_files: int = 64):
+        """
+        Splits an annotate_variation output of the batch into the output files of the separate files (outfile + suffix):
+        the tags are removed and the input line numbers of the exonic output are renumbered per file.
+        The (empty) variant_function and exonic_variant_function are created for every file, like a separate run.
+        """
+        if not os.path.isfile(batch_output):
+            return
+        if suffix != ".invalid_input":
+            for outfile in outfiles:
+                open(outfile + suffix, "w").close()
+        created = set()
+        handles = OrderedDict()
+        try:
+            with open(batch_output, "r") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    tag = BATCH_TAG.search(line)
+                    if tag is None:
+                        logging.error(f"Untagged line in batched annotate_variation output: {line}")
+                        continue
+                    number = int(tag.group(1))
+                    line = line[: tag.start()]
+                    if suffix == ".exonic_variant_function":
+                        line = "line" + tag.group(2) + line[line.index("\t"):]
+                    handle = handles.pop(number, None)
+                    if handle is None:
+                        if len(handles) >= max_open_files:
+                            handles.popitem(last=False)[1].close()
+                        # Files of the other outputs were created above, invalid_input only for files with invalid lines
+                        mode = "a" if number in created or suffix != ".invalid_input" else "w"
+                        handle = open(outfiles[number] + suffix, mode)
+                        created.add(number)
+                    handles[number] = handle
+                    handle.write(line + "\n")
+        finally:
+            for handle in handles.values():
+                handle.close()
+
     def run_coding_change_pipeline(self, commands: str):
         """
         Runs the coding_change perl script of Annovar on .exonic_variant_function files.
-        Creates an output folder "fastas" with fasta files.
+        Creates an output folder "fastas" with fasta files, the files are processed concurrently by the command_runner.
         """
-        fasta_files = 0
         # split command string into list, process.Popen needs a list
         commands = [i for i in commands.split(" ")]
         file_list = self.path_handler.file_list(self.path_handler.input_path)
@@ -66,24 +174,28 @@ class AnnovarPipeline:
         logging.info(
             f"Processing {len(file_list)} files in {self.path_handler.input_path}"
         )
-        for file in file_list:
-            logging.info(f"Starting annotation of {file[1]}")
-            try:
-                outfile = os.path.join(fastas_path, file[1])
-                self.command_runner.run(
+        fasta_files = self.run_file_commands(
+            [
+                (
+                    file,
                     ["perl", "annovar/coding_change.pl"]
                     + [file[0]]
-                    + ["--outfile", outfile]
-                    + commands
+                    + ["--outfile", os.path.join(fastas_path, file[1])]
+                    + commands,
                 )
-                fasta_files += 1
-                logging.info(f"Finished annotation of {file[1]}")
-            except Exception as e:
-                logging.error("Error occurred while annotating file: %s", file[1])
-                logging.error(str(e))
-                raise
+                for file in file_list
+            ]
+        )
         logging.info(
             f"Finished creating fastas for {fasta_files} out of {len(file_list)} files."
         )
+        # Index the fastas once for random access by the next steps
+        try:
+            FastaIndex(self.path_handler.output_path).build(
+                self.path_handler.file_list(fastas_path)
+            )
+        except Exception as e:
+            logging.error("Error occurred while indexing the fastas")
+            logging.error(str(e))
         # The /fastas dir becomes the new input dir
         self.path_handler.update_input(fastas_path)
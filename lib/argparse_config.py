@@ -10,6 +10,16 @@ import os
 import argparse
 
 
+def positive_int(value: str) -> int:
+    """
+    Argparse type for counts that must be at least 1 (CPUs, workers).
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
 def parse_the_args():
     """
     Full argument parsing config, this is imported in main().
@@ -27,8 +37,30 @@ def parse_the_args():
         default=os.getcwd(),
         help="Provide output folder path. If none is specified, current working directory is used.",
     )
+    parser.add_argument(
+        "--cpus",
+        type=positive_int,
+        default=None,
+        help="CPU budget of the external tools (fastqc, cutadapt, ANNOVAR, --cmd) running at once. Default is all CPUs.",
+    )
     parser.add_argument("--qc", action="store_true", help="perform QC")
     parser.add_argument("--m2a", action="store_true", help="Convert MAF to AVINPUT")
+    parser.add_argument(
+        "--m2a_workers",
+        type=positive_int,
+        default=1,
+        help="Amount of worker processes converting (and decompressing) MAF files in parallel. MAFs may be gzip compressed (.maf.gz) and in subfolders, e.g. a GDC download folder. Default is 1.",
+    )
+    parser.add_argument(
+        "--m2a_split_samples",
+        action="store_true",
+        help="Split cohort MAFs (e.g. the TCGA mc3 MAF) into one AVINPUT per Tumor_Sample_Barcode in a single pass, the barcodes become the sample names.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Incremental mode: only process new or changed samples (tracked in incremental_manifest.json in the output folder) and merge their predictions into the existing predictions.csv.",
+    )
 
     cutadapt_parser = parser.add_argument_group("cutadapt", "Cutadapt")
     cutadapt_parser.add_argument(
@@ -49,9 +81,25 @@ def parse_the_args():
         action="store_true",
         help="Perform annotate_variation.",
     )
+    annovar_parser.add_argument(
+        "--annovar_batch",
+        action="store_true",
+        help="Run annotate_variation once on all AVINPUT files (the database is loaded once) and split the output per sample, recommended for cohorts with many small files.",
+    )
+    annovar_parser.add_argument(
+        "--annovar_workers",
+        type=positive_int,
+        default=8,
+        help="Maximum amount of annotate_variation/coding_change (perl) processes running at once, one per sample file, within the --cpus budget. Default is 8.",
+    )
     annovar_parser.add_argument(
         "--annovar_coding_change", action="store_true", help="Perform coding_change."
     )
+    annovar_parser.add_argument(
+        "--native_coding_change",
+        action="store_true",
+        help="Use the native (Python) coding_change engine instead of coding_change.pl: the variants are translated in memory using an index of --refgene and --refgene_mrna built once and passed to MHCflurry directly, the fastas are written as well. Of --annovar_coding_change_commands only --alltranscript applies, --includesnp --onlyAltering --tolerate are implied.",
+    )
     annovar_parser.add_argument(
         "--annovar_coding_change_commands",
         type=str,
@@ -65,6 +113,19 @@ def parse_the_args():
         help='Enter commands for annovar, excluding input and output, as string default: "-build hg38 -dbtype refGene annovar/humandb/ --comment"',
     )
 
+    annovar_parser.add_argument(
+        "--refgene",
+        type=str,
+        default="annovar/humandb/hg38_refGene.txt",
+        help="ANNOVAR refGene table used for the reference proteome, default: annovar/humandb/hg38_refGene.txt",
+    )
+    annovar_parser.add_argument(
+        "--refgene_mrna",
+        type=str,
+        default="annovar/humandb/hg38_refGeneMrna.fa",
+        help="ANNOVAR refGene mRNA fasta used for the reference proteome, default: annovar/humandb/hg38_refGeneMrna.fa",
+    )
+
     HLA_parser = parser.add_argument_group("HLA", "HLA")
     HLA_parser.add_argument(
         "--HLA_TCGA", action="store_true", help="Use TCGA source for HLA alleles."
@@ -95,6 +156,64 @@ def parse_the_args():
         nargs="+",
         help="Enter length(s) of peptides to scan for, separated by spaces. Default is 9."
     )
+    mhcflurry_parser.add_argument(
+        "--mhcflurry_batch_size",
+        type=positive_int,
+        default=10000,
+        help="Amount of peptides sent to MHCflurry per prediction call when using --add_flanks. Default is 10000.",
+    )
+    mhcflurry_parser.add_argument(
+        "--mhcflurry_chunk_size",
+        type=positive_int,
+        default=None,
+        help="Stream predictions to predictions.csv in chunks of about this many peptides, memory use depends on the chunk size instead of the cohort size. Default is predicting everything at once.",
+    )
+    mhcflurry_parser.add_argument(
+        "--mhcflurry_workers",
+        type=positive_int,
+        default=1,
+        help="Amount of worker processes for MHCflurry, every worker loads the models once. Default is 1.",
+    )
+    mhcflurry_parser.add_argument(
+        "--cropping_workers",
+        type=positive_int,
+        default=1,
+        help="Amount of worker processes cropping the fasta files before prediction. Default is 1.",
+    )
+    mhcflurry_parser.add_argument(
+        "--mhcflurry_cache",
+        type=str,
+        default=None,
+        help="Path to a persistent prediction cache (SQLite) reused across runs when using --add_flanks, created if it doesn't exist.",
+    )
+    mhcflurry_parser.add_argument(
+        "--mhcflurry_cache_size",
+        type=int,
+        default=10000000,
+        help="Maximum amount of cached predictions, least recently used predictions are evicted. Default is 10000000.",
+    )
+    mhcflurry_parser.add_argument(
+        "--filter_self_peptides",
+        action="store_true",
+        help="Drop peptides found in the reference proteome (--refgene, --refgene_mrna) before prediction when using --add_flanks. The k-mer index is built once next to the mRNA fasta.",
+    )
+    mhcflurry_parser.add_argument(
+        "--cascade_affinity",
+        type=float,
+        default=None,
+        help="Cascade mode for --add_flanks: score all peptides with the affinity predictor first, only peptides with an affinity (nM) under this cutoff get presentation scores, e.g. 500.",
+    )
+    mhcflurry_parser.add_argument(
+        "--cascade_percentile",
+        type=float,
+        default=None,
+        help="Cascade mode for --add_flanks: only peptides with an affinity percentile under this cutoff get presentation scores, e.g. 2. Combined with --cascade_affinity, passing either cutoff is enough.",
+    )
+    mhcflurry_parser.add_argument(
+        "--wildtype",
+        action="store_true",
+        help="Also predict the wildtype counterpart of every peptide (SNPs) when using --add_flanks, adds the wt_affinity and agretopicity (affinity / wt_affinity) columns.",
+    )
     mhcflurry_parser.add_argument(
         "--TCGA_alleles",
         action='store_true',
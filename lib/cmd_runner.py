@@ -1,44 +1,243 @@
-import subprocess
+import os
+import re
+import time
+import asyncio
 import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Default maximum amount of concurrent commands per tool (executable name), other tools are only bound by the CPU budget
+DEFAULT_TOOL_LIMITS = {"fastqc": 4, "perl": 8}
+# Output streaming: the last RING_LINES lines of a command are kept in memory,
+# at most one log record of LOG_LINES lines is written every LOG_INTERVAL seconds
+RING_LINES = 1000
+LOG_LINES = 20
+LOG_INTERVAL = 5.0
+READ_SIZE = 1 << 16
+
+
+class CommandError(Exception):
+    '''
+    A scheduled command that failed, attributed to its tool and label (e.g. the input file).
+    '''
+    def __init__(self, tool:str, label:str, command:list, return_code):
+        self.tool = tool
+        self.label = label
+        self.command = command
+        self.return_code = return_code
+        reason = "could not be run" if return_code is None else f"failed with return code {return_code}"
+        super().__init__(f"{tool} {reason} for {label}: {' '.join(command)}")
+
 
 class CommandRunner:
     '''
-    Acts as a template for running commands in a subprocess.
+    Acts as a template for running commands in a subprocess, the output is streamed to batched log records
+    and (with a log_dir) to a log file per command.
+    Commands can also be submitted to the scheduler, which runs them concurrently within a global CPU budget
+    and per-tool concurrency limits and returns a future per command.
     '''
-    def __init__(self):
-        pass
+    def __init__(self, cpu_budget:int=None, tool_limits:dict=None, log_dir:str=None):
+        self.cpu_budget = cpu_budget if cpu_budget is not None else os.cpu_count() or 1  # CPUs used by running commands at most
+        self.tool_limits = dict(DEFAULT_TOOL_LIMITS, **(tool_limits or {}))  # {tool: max concurrent commands}
+        # Nothing would ever be dispatched (and gather/shutdown would wait forever) with a budget or limit below 1
+        if self.cpu_budget < 1:
+            raise ValueError(f"CPU budget must be at least 1, got {self.cpu_budget}")
+        for tool, limit in self.tool_limits.items():
+            if limit < 1:
+                raise ValueError(f"Limit of {tool} must be at least 1, got {limit}")
+        self.log_dir = log_dir  # full raw output of every command is written here, if given
+        self.lock = threading.Condition()
+        self.pending = deque()  # submitted commands waiting for CPUs or a tool slot
+        self.running_cpus = 0
+        self.running_tools = {}  # {tool: running commands}
+        self.executor = None
 
 
-    def run(self, command:list):
+    def run(self, command:list, label:str=None):
         '''
-        Run command using subprocess, will log everything.
+        Run command in a subprocess, its output is streamed by run_async.
+        Returns the return code of the command (None if it couldn't be run).
         '''
         logging.info(f"Running command: {' '.join(command)}")
 
         try:
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-
-            while True:
-                output = process.stdout.readline()
-                if not output and process.poll() is not None:
-                    break
-                if output:
-                    logging.info(output.strip())
-
-            return_code = process.wait()
+            return_code, ring, log_file = asyncio.run(self.run_async(command, label))
             if return_code != 0:
                 logging.error(f"Command failed with return code {return_code}")
+                if ring:
+                    logging.error("Last output lines:\n" + "\n".join(ring))
+                if log_file:
+                    logging.error(f"Full output in {log_file}")
+            return return_code
 
         except Exception as e:
             logging.error(f"Error occurred while running command: {' '.join(command)}")
             logging.error(str(e))
+            return None
+
+    def command_log(self, command:list, label:str=None) -> str:
+        '''
+        Path of the raw output log of a command: log_dir/<tool>.<label>.log (None without log_dir).
+        '''
+        if self.log_dir is None:
+            return None
+        os.makedirs(self.log_dir, exist_ok=True)
+        name = re.sub(r"[^\w.-]+", "_", f"{self.tool(command)}.{label or ' '.join(command[1:])}")[:200]
+        return os.path.join(self.log_dir, name + ".log")
+
+    async def run_async(self, command:list, label:str=None) -> tuple:
+        '''
+        Runs command, stdout and stderr are drained from non-blocking pipes into a ring buffer of the last RING_LINES lines
+        and written unaltered to the command log. The output is logged in batches, at most one record per LOG_INTERVAL seconds.
+        Returns the return code, the last output lines and the command log path.
+        '''
+        ring = deque(maxlen=RING_LINES)
+        state = {"new": 0, "lines": 0}  # lines not logged yet, lines read
+        log_file = self.command_log(command, label)
+        name = label or self.tool(command)
+
+        async def drain(stream):
+            partial = b""
+            while True:
+                chunk = await stream.read(READ_SIZE)
+                if not chunk:
+                    break
+                if raw:
+                    raw.write(chunk)
+                lines = (partial + chunk).split(b"\n")
+                partial = lines.pop()
+                for line in lines:
+                    ring.append(line.decode(errors="replace").rstrip("\r"))
+                state["new"] += len(lines)
+                state["lines"] += len(lines)
+            if partial:
+                ring.append(partial.decode(errors="replace").rstrip("\r"))
+                state["new"] += 1
+                state["lines"] += 1
+
+        def flush():
+            if state["new"]:
+                shown = list(ring)[-min(state["new"], LOG_LINES, len(ring)):]
+                skipped = state["new"] - len(shown)
+                header = f"{name}: {state['new']} new output lines" + (f" ({skipped} not shown)" if skipped else "")
+                logging.info(header + "\n" + "\n".join(shown))
+                state["new"] = 0
+
+        async def report():
+            while True:
+                await asyncio.sleep(LOG_INTERVAL)
+                flush()
+
+        # The command log is opened first, a failing open never leaves a child process behind
+        raw = open(log_file, "wb") if log_file else None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            reporter = asyncio.create_task(report())
+            try:
+                await asyncio.gather(drain(process.stdout), drain(process.stderr))
+                return_code = await process.wait()
+            finally:
+                reporter.cancel()
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                flush()
+        finally:
+            if raw:
+                raw.close()
+        logging.info(f"{name}: {state['lines']} output lines" + (f", full output in {log_file}" if log_file else ""))
+        return return_code, list(ring)[-LOG_LINES:], log_file
+
+    def tool(self, command:list) -> str:
+        '''
+        Tool of a command (executable name), the per-tool limits apply to it.
+        '''
+        return os.path.basename(command[0])
+
+    def submit(self, command:list, label:str=None, cpus:int=1) -> Future:
+        '''
+        Schedules a command, returns a future with the return code (0) or a CommandError if the command failed.
+        The command starts once cpus (capped at the budget) are free and its tool is below its limit.
+        '''
+        future = Future()
+        job = (command, label or " ".join(command), min(max(1, cpus), self.cpu_budget), future)
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.cpu_budget)
+            self.pending.append(job)
+            self.dispatch()
+        return future
+
+    def dispatch(self):
+        '''
+        Starts the pending commands that fit (in submission order, commands of a tool at its limit are passed over).
+        Called with the lock held.
+        '''
+        for job in list(self.pending):
+            tool, cpus = self.tool(job[0]), job[2]
+            if self.running_cpus + cpus > self.cpu_budget:
+                continue
+            if self.running_tools.get(tool, 0) >= self.tool_limits.get(tool, self.cpu_budget):
+                continue
+            self.pending.remove(job)
+            self.running_cpus += cpus
+            self.running_tools[tool] = self.running_tools.get(tool, 0) + 1
+            self.executor.submit(self.execute, job)
+
+    def execute(self, job:tuple):
+        '''
+        Runs a scheduled command in a scheduler thread and settles its future.
+        '''
+        command, label, cpus, future = job
+        tool = self.tool(command)
+        try:
+            if future.set_running_or_notify_cancel():
+                return_code = self.run(command, label)
+                if return_code == 0:
+                    future.set_result(return_code)
+                else:
+                    future.set_exception(CommandError(tool, label, command, return_code))
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            with self.lock:
+                self.running_cpus -= cpus
+                self.running_tools[tool] -= 1
+                self.dispatch()
+                self.lock.notify_all()
+
+    def gather(self, futures:dict) -> tuple:
+        '''
+        Waits for scheduled commands ({label: future}), every failure is logged with its label.
+        Returns the labels of the succeeded commands and {label: error} of the failed ones.
+        '''
+        succeeded, failed = [], {}
+        for label, future in futures.items():
+            try:
+                future.result()
+                succeeded.append(label)
+            except Exception as e:
+                logging.error(f"Command for {label} failed: {e}")
+                failed[label] = e
+        return succeeded, failed
+
+    def shutdown(self):
+        '''
+        Waits for the scheduled commands and stops the scheduler threads.
+        '''
+        with self.lock:
+            self.lock.wait_for(lambda: not self.pending and self.running_cpus == 0)
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
 
-    @ staticmethod 
     def configure_command(self,input:str,output:str,cmds:str):
         '''
         Configure command to standard format.
         '''
         cmds = [i for i in cmds.split(" ")]
         return [cmds[0],'--input',input,'--output',output] + cmds[1:]
-    
-    
\ No newline at end of file
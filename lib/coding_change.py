@@ -0,0 +1,448 @@
+import os
+import re
+import json
+import mmap
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+from lib.fasta_index import FastaIndex
+from lib.file_utils import temp_path
+from lib.reference import cds_range, translate, read_refgene_records, source_manifest, manifest_is_current
+
+# Structured coding_change record, passed to cropping without a fasta round-trip.
+# mutation/pos/length as CroppingFlanksPipeline.parse_header returns them (pos is the python index in the protein),
+# sequence and wildtype are the mutant and wildtype proteins without stop codon.
+ProteinChange = namedtuple(
+    "ProteinChange", ["lineX", "transcript", "mutation", "pos", "length", "sequence", "wildtype"]
+)
+
+# cDNA changes of the ANNOVAR exonic annotation (c. positions are relative to the CDS start)
+_SNV = re.compile(r"^c\.([ACGTN])(\d+)([ACGTN])$")
+_DELINS = re.compile(r"^c\.(\d+)(?:_(\d+))?delins([ACGTN]+)$")
+_INS = re.compile(r"^c\.(\d+)_(\d+)ins([ACGTN]+)$")
+_DUP = re.compile(r"^c\.(\d+)(?:_(\d+))?dup([ACGTN]*)$")
+_DEL = re.compile(r"^c\.(\d+)(?:_(\d+))?del([ACGTN]*)$")
+
+# Exonic functions without protein change (coding_change.pl --onlyAltering)
+_NOT_ALTERING = ("synonymous SNV", "unknown", "UNKNOWN")
+# coding_change.pl options the engine always applies (SNVs included, only altering variants, errors tolerated per variant)
+_IMPLIED_OPTIONS = ("--includesnp", "--onlyAltering", "--tolerate")
+
+
+def _joined(names: list) -> np.ndarray:
+    # Names as one "\n" separated UTF-8 byte array
+    return np.frombuffer("\n".join(names).encode(), dtype=np.uint8)
+
+
+def _split(array: np.ndarray) -> list:
+    names = array.tobytes().decode()
+    return names.split("\n") if names else []
+
+
+class CodingChangeEngine:
+    """
+    Native replacement of ANNOVAR's coding_change.pl: translates the exonic variants of exonic_variant_function files
+    into mutant (and wildtype) proteins in memory.
+    refGene is kept as a persistent interval index (NumPy columns sorted by chromosome and transcript start) and
+    refGeneMrna as an offset index over the memory-mapped fasta, both built once next to the mRNA fasta and versioned.
+    """
+
+    VERSION = 1
+
+    def __init__(self, refgene_path: str, mrna_path: str, index_dir: str = None, all_transcripts: bool = True):
+        self.refgene_path = os.path.abspath(refgene_path)
+        self.mrna_path = os.path.abspath(mrna_path)
+        self.index_dir = os.path.abspath(index_dir or self.mrna_path + ".coding_change")
+        self.all_transcripts = all_transcripts  # like --alltranscript, otherwise only the first transcript of a variant
+        self.refgene = None  # {column: array}
+        self.mrna = None  # {column: array}
+        self.transcript_rows = None  # {transcript name: [refGene rows]}
+        self.chrom_rows = None  # {chromosome: (first row, end row, longest transcript)}
+        self.mrna_ids = None  # {mRNA id: mRNA row}
+        self.mrna_map = None
+
+    @classmethod
+    def from_commands(cls, refgene_path: str, mrna_path: str, commands: str):
+        """
+        Engine for the coding_change.pl commands (--annovar_coding_change_commands): --alltranscript is applied,
+        options the engine doesn't support and reference files other than refgene_path/mrna_path are logged as ignored.
+        """
+        options = [command for command in commands.split(" ") if command]
+        for command in options:
+            if command.startswith("-"):
+                if command != "--alltranscript" and command not in _IMPLIED_OPTIONS:
+                    logging.warning(f"coding_change option {command} is not supported by the native engine and is ignored")
+            elif os.path.abspath(command) not in (os.path.abspath(refgene_path), os.path.abspath(mrna_path)):
+                logging.warning(
+                    f"Native coding_change uses {refgene_path} and {mrna_path} (--refgene, --refgene_mrna), not {command}"
+                )
+        return cls(refgene_path, mrna_path, all_transcripts="--alltranscript" in options)
+
+    def __getstate__(self):
+        # Worker processes map the mRNA fasta themselves
+        state = self.__dict__.copy()
+        state["mrna_map"] = None
+        return state
+
+    def manifest(self) -> dict:
+        """
+        Version and source file stamps the index was built from.
+        """
+        return source_manifest(self.VERSION, (self.refgene_path, self.mrna_path))
+
+    def is_current(self) -> bool:
+        """
+        Checks if the index on disk was built by this version from the current sources.
+        """
+        return manifest_is_current(self.index_dir, self.manifest())
+
+    def build_refgene(self) -> dict:
+        """
+        Reads the refGene table into columns sorted by (chromosome, transcript start), exons as CSR columns.
+        """
+        rows = [
+            (
+                record["chrom"],
+                record["tx_start"],
+                record["name"],
+                record["strand"],
+                record["tx_end"],
+                record["cds_start"],
+                record["cds_end"],
+                record["exon_starts"],
+                record["exon_ends"],
+            )
+            for record in read_refgene_records(self.refgene_path)
+        ]
+        rows.sort(key=lambda row: (row[0], row[1]))
+        chroms = sorted(set(row[0] for row in rows))
+        chrom_ids = {chrom: i for i, chrom in enumerate(chroms)}
+        exon_counts = np.array([len(row[7]) for row in rows], dtype=np.int64)
+        return {
+            "names": _joined([row[2] for row in rows]),
+            "chroms": _joined(chroms),
+            "chrom": np.array([chrom_ids[row[0]] for row in rows], dtype=np.int32),
+            "strand": np.array([row[3] == "+" for row in rows], dtype=bool),
+            "tx_start": np.array([row[1] for row in rows], dtype=np.int64),
+            "tx_end": np.array([row[4] for row in rows], dtype=np.int64),
+            "cds_start": np.array([row[5] for row in rows], dtype=np.int64),
+            "cds_end": np.array([row[6] for row in rows], dtype=np.int64),
+            "exon_offsets": np.concatenate(([0], np.cumsum(exon_counts))),
+            "exon_starts": np.array([x for row in rows for x in row[7]], dtype=np.int64),
+            "exon_ends": np.array([x for row in rows for x in row[8]], dtype=np.int64),
+        }
+
+    def build_mrna(self) -> dict:
+        """
+        Scans the mRNA fasta once: id, byte offset and byte length (line breaks included) of every sequence.
+        """
+        ids, offsets, lengths = [], [], []
+        position, start = 0, None
+        with open(self.mrna_path, "rb") as f:
+            for line in f:
+                if line.startswith(b">"):
+                    if start is not None:
+                        lengths.append(position - start)
+                    ids.append(line[1:].split()[0].decode() if line[1:].split() else "")
+                    start = position + len(line)
+                    offsets.append(start)
+                position += len(line)
+        if start is not None:
+            lengths.append(position - start)
+        return {
+            "ids": _joined(ids),
+            "offsets": np.array(offsets, dtype=np.int64),
+            "lengths": np.array(lengths, dtype=np.int64),
+        }
+
+    def build(self):
+        """
+        Builds the refGene and mRNA index.
+        """
+        logging.info(f"Building coding_change index in {self.index_dir}...")
+        os.makedirs(self.index_dir, exist_ok=True)
+        np.savez(os.path.join(self.index_dir, "refgene.npz"), **self.build_refgene())
+        np.savez(os.path.join(self.index_dir, "mrna.npz"), **self.build_mrna())
+        with open(os.path.join(self.index_dir, "manifest.json"), "w") as f:
+            json.dump(self.manifest(), f)
+        logging.info("Coding_change index built.")
+
+    def load(self):
+        """
+        Loads the index (building it first if missing or outdated) and maps the mRNA fasta.
+        """
+        if self.refgene is None:
+            if not self.is_current():
+                self.build()
+            with np.load(os.path.join(self.index_dir, "refgene.npz")) as data:
+                self.refgene = {column: data[column] for column in data.files}
+            with np.load(os.path.join(self.index_dir, "mrna.npz")) as data:
+                self.mrna = {column: data[column] for column in data.files}
+            self.refgene["names"] = _split(self.refgene["names"])
+            self.refgene["chroms"] = _split(self.refgene["chroms"])
+            self.transcript_rows = {}
+            for row, name in enumerate(self.refgene["names"]):
+                self.transcript_rows.setdefault(name, []).append(row)
+            self.chrom_rows = {}
+            chrom = self.refgene["chrom"]
+            lengths = self.refgene["tx_end"] - self.refgene["tx_start"]
+            for i, name in enumerate(self.refgene["chroms"]):
+                first, end = np.searchsorted(chrom, i, "left"), np.searchsorted(chrom, i, "right")
+                self.chrom_rows[name] = (int(first), int(end), int(lengths[first:end].max()) if end > first else 0)
+            self.mrna_ids = {}
+            for row, mrna_id in enumerate(_split(self.mrna["ids"])):
+                self.mrna_ids.setdefault(mrna_id, row)
+        if self.mrna_map is None:
+            with open(self.mrna_path, "rb") as f:
+                self.mrna_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def overlapping(self, chrom: str, position: int) -> np.ndarray:
+        """
+        Interval query: refGene rows of the transcripts overlapping a (1-based) chromosome position.
+        """
+        if chrom not in self.chrom_rows:
+            return np.empty(0, dtype=np.int64)
+        first, end, longest = self.chrom_rows[chrom]
+        tx_start = self.refgene["tx_start"]
+        # Transcripts starting more than the longest transcript before the position can't overlap it
+        low = first + np.searchsorted(tx_start[first:end], position - longest - 1, "left")
+        high = first + np.searchsorted(tx_start[first:end], position, "left")
+        rows = np.arange(low, high)
+        return rows[self.refgene["tx_end"][rows] >= position]
+
+    def transcript_row(self, name: str, chrom: str, position: int):
+        """
+        refGene row of a transcript at the variant: transcripts can map to multiple loci (e.g. PAR regions).
+        """
+        rows = self.transcript_rows.get(name)
+        if not rows:
+            return None
+        if len(rows) > 1:
+            overlapping = set(self.overlapping(chrom, position).tolist())
+            for row in rows:
+                if row in overlapping:
+                    return row
+        return rows[0]
+
+    def record(self, row: int) -> dict:
+        """
+        refGene record of a row, as lib.reference reads them.
+        """
+        refgene = self.refgene
+        exons = slice(refgene["exon_offsets"][row], refgene["exon_offsets"][row + 1])
+        return {
+            "name": refgene["names"][row],
+            "chrom": refgene["chroms"][refgene["chrom"][row]],
+            "strand": "+" if refgene["strand"][row] else "-",
+            "tx_start": int(refgene["tx_start"][row]),
+            "tx_end": int(refgene["tx_end"][row]),
+            "cds_start": int(refgene["cds_start"][row]),
+            "cds_end": int(refgene["cds_end"][row]),
+            "exon_starts": refgene["exon_starts"][exons].tolist(),
+            "exon_ends": refgene["exon_ends"][exons].tolist(),
+        }
+
+    def mrna_sequence(self, record: dict):
+        """
+        mRNA sequence of a refGene record from the mapped fasta, ids 'NM_...#chrom#txStart' or 'NM_...'.
+        """
+        for mrna_id in (
+            f"{record['name']}#{record['chrom']}#{record['tx_start'] + 1}",
+            f"{record['name']}#{record['chrom']}#{record['tx_start']}",
+            record["name"],
+        ):
+            row = self.mrna_ids.get(mrna_id)
+            if row is not None:
+                offset, length = self.mrna["offsets"][row], self.mrna["lengths"][row]
+                return "".join(self.mrna_map[offset : offset + length].decode().split()).upper()
+        return None
+
+    def cdna_edit(self, change: str, cds: str):
+        """
+        Parses a cDNA change into a (start, end, alt) edit of the coding sequence: cds[start:end] becomes alt.
+        """
+        match = _SNV.match(change)
+        if match:
+            position = int(match.group(2))
+            return position - 1, position, match.group(3)
+        match = _DELINS.match(change)
+        if match:
+            start = int(match.group(1))
+            return start - 1, int(match.group(2) or start), match.group(3)
+        match = _INS.match(change)
+        if match:
+            start = int(match.group(1))
+            return start, start, match.group(3)
+        match = _DUP.match(change)
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2) or start)
+            return end, end, match.group(3) or cds[start - 1 : end]
+        match = _DEL.match(change)
+        if match:
+            start = int(match.group(1))
+            return start - 1, int(match.group(2) or start), ""
+        return None
+
+    def protein_change(self, lineX: str, transcript: str, chrom: str, position: int, change: str):
+        """
+        Applies the cDNA change of a variant to its transcript and compares the translated proteins.
+        Returns a ProteinChange, None if the protein isn't altered or the transcript is unknown.
+        """
+        row = self.transcript_row(transcript, chrom, position)
+        if row is None:
+            return None
+        record = self.record(row)
+        mrna = self.mrna_sequence(record)
+        if mrna is None or record["cds_start"] == record["cds_end"]:
+            return None
+        cds_start, cds_end = cds_range(record)
+        edit = self.cdna_edit(change, mrna[cds_start:cds_end])
+        if edit is None or edit[1] > cds_end - cds_start:
+            return None
+        start, end, alt = edit
+        # The mutant is translated into the 3'UTR until a stop codon (frameshifts, stoplosses)
+        region = mrna[cds_start:]
+        wildtype = translate(mrna[cds_start:cds_end])
+        mutant = translate(region[:start] + alt + region[end:])
+
+        # First changed residue
+        i = 0
+        shortest = min(len(wildtype), len(mutant))
+        while i < shortest and wildtype[i] == mutant[i]:
+            i += 1
+        if i == len(wildtype) == len(mutant):
+            return None
+        if (len(alt) - (end - start)) % 3:
+            # Frameshift: length up to the new stop codon (fs*length)
+            return ProteinChange(lineX, transcript, "indel", i, len(mutant) + 1 - i, mutant, wildtype)
+        if len(mutant) < len(wildtype) and wildtype.startswith(mutant):
+            # Stopgain
+            return ProteinChange(lineX, transcript, "snp", i, 0, mutant, wildtype)
+        # Unchanged residues after the change
+        k = 0
+        while k < shortest - i and wildtype[-1 - k] == mutant[-1 - k]:
+            k += 1
+        deleted = wildtype[i : len(wildtype) - k]
+        inserted = mutant[i : len(mutant) - k]
+        if len(deleted) == 1 and len(inserted) == 1:
+            return ProteinChange(lineX, transcript, "snp", i, 0, mutant, wildtype)
+        if not inserted:
+            return ProteinChange(lineX, transcript, "del", i, 0, mutant, wildtype)
+        if not deleted:
+            return ProteinChange(lineX, transcript, "ins", i - 1, len(inserted), mutant, wildtype)
+        return ProteinChange(lineX, transcript, "indel", i, len(inserted), mutant, wildtype)
+
+    def file_protein_changes(self, input_file: str) -> list:
+        """
+        ProteinChanges of all altering variants in an exonic_variant_function file, in file and transcript order.
+        """
+        self.load()
+        changes = []
+        with open(input_file, "r") as f:
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                try:
+                    if len(fields) < 5 or fields[1] in _NOT_ALTERING:
+                        continue
+                    lineX, chrom, position = fields[0], fields[3], int(fields[4])
+                    entries = [entry for entry in fields[2].split(",") if entry]
+                    for entry in entries if self.all_transcripts else entries[:1]:
+                        parts = entry.split(":")
+                        cdna = [part for part in parts if part.startswith("c.")]
+                        if len(parts) < 2 or not cdna:
+                            continue
+                        change = self.protein_change(lineX, parts[1], chrom, position, cdna[0])
+                        if change is not None:
+                            changes.append(change)
+                except Exception as e:
+                    logging.warning(f"Ignoring exonic variant {fields[0]} in {input_file}: {e}")
+        return changes
+
+    def fasta_header(self, change: ProteinChange) -> str:
+        """
+        coding_change.pl style header of a mutant record, the protein change notation parses back
+        to the same mutation, position and length in CroppingFlanksPipeline.parse_header.
+        """
+        i, wildtype, mutant = change.pos, change.wildtype, change.sequence
+        if change.mutation == "snp":
+            notation = f"{wildtype[i:i + 1] or '*'}{i + 1}{mutant[i:i + 1] or '*'}"
+        elif change.mutation == "del":
+            notation = f"{wildtype[i:i + 1]}{i + 1}del"
+        elif change.mutation == "ins":
+            # pos is the residue before the insertion
+            inserted = mutant[i + 1 : i + 1 + change.length]
+            notation = f"{wildtype[i:i + 1] or 'X'}{i + 1}_{wildtype[i + 1:i + 2] or '*'}{i + 2}ins{inserted}"
+        elif change.length == len(mutant) + 1 - i:
+            # Frameshift: length up to the new stop codon
+            notation = f"{wildtype[i:i + 1]}{i + 1}{mutant[i:i + 1] or '*'}fs*{change.length}"
+        else:
+            notation = f"{wildtype[i:i + 1]}{i + 1}delins{mutant[i:i + change.length]}"
+        return f"{change.lineX} {change.transcript} p.{notation} protein-altering"
+
+    def write_fasta(self, changes: list, outfile: str):
+        """
+        Writes ProteinChanges as a coding_change.pl style fasta: a WILDTYPE record followed by the mutant record,
+        sequences end with '*'. Written to a temporary file first, partial fastas are never left behind.
+        """
+        temp_file = temp_path(outfile)
+        try:
+            with open(temp_file, "w") as f:
+                for change in changes:
+                    f.write(f">{change.lineX} {change.transcript} WILDTYPE\n{change.wildtype}*\n")
+                    f.write(f">{self.fasta_header(change)}\n{change.sequence}*\n")
+            os.replace(temp_file, outfile)
+        except Exception:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+    def run_pipeline(self, path_handler) -> dict:
+        """
+        Translates the exonic_variant_function files in the input folder.
+        The protein changes are also written to a fasta per file in the "fastas" output folder (like coding_change.pl),
+        which is indexed and becomes the new input dir.
+        Returns {sample: [ProteinChange,...]}, SAMPLE = filename before any "."
+        """
+        protein_changes = {}
+        file_list = [
+            file
+            for file in path_handler.file_list(path_handler.input_path)
+            if file[0].endswith(".exonic_variant_function")
+        ]
+        fastas_path = path_handler.output_subfolder("fastas")
+        for file in file_list:
+            logging.info(f"Starting coding change of {file[1]}")
+            try:
+                changes = self.file_protein_changes(file[0])
+                self.write_fasta(changes, os.path.join(fastas_path, file[1]))
+                protein_changes[file[1].split(".")[0]] = changes
+                logging.info(f"Finished coding change of {file[1]}")
+            except Exception as e:
+                logging.error("Error occurred while processing file: %s", file[1])
+                logging.error(str(e))
+        logging.info(
+            f"Finished coding change for {len(protein_changes)} out of {len(file_list)} files "
+            f"({sum(len(changes) for changes in protein_changes.values())} protein changes)."
+        )
+        # Index the fastas once for random access by the next steps
+        try:
+            FastaIndex(path_handler.output_path).build(path_handler.file_list(fastas_path))
+        except Exception as e:
+            logging.error("Error occurred while indexing the fastas")
+            logging.error(str(e))
+        # The /fastas dir becomes the new input dir
+        path_handler.update_input(fastas_path)
+        return protein_changes
+
+    def close(self):
+        """
+        Closes the memory-mapped mRNA fasta.
+        """
+        if self.mrna_map is not None:
+            self.mrna_map.close()
+            self.mrna_map = None
@@ -1,5 +1,9 @@
 import os
 import logging
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.coding_change import ProteinChange
 
 
 class CroppingFlanksPipeline:
@@ -7,8 +11,10 @@ class CroppingFlanksPipeline:
     Class for reading fasta files and retrieving the sequences and flanks for further MHC-binding analysis.
     """
 
-    def __init__(self, path_handler):
+    def __init__(self, path_handler, workers: int = 1, fasta_index=None):
         self.path_handler = path_handler
+        self.workers = workers  # > 1: fasta files are cropped concurrently by a process pool
+        self.fasta_index = fasta_index  # FastaIndex, indexed fastas are read record by record through mmap
 
     def parse_header(self, header: str):
         """
@@ -87,54 +93,142 @@ class CroppingFlanksPipeline:
             remaining_right,
         )
 
-    def process_fasta_file(self, input_file: str, flank_length: int):
+    def read_fasta_records(self, input_file: str):
+        """
+        Generator that streams the (header, sequence) records of a fasta file, records without sequence are skipped.
+        Sequence lines are joined once per record.
+        """
+        with open(input_file, "r") as file:
+            header, parts = "", []
+            for line in file:
+                if line.startswith(">"):
+                    if parts:
+                        yield header, "".join(parts)
+                        parts = []
+                    header = line.strip()
+                else:
+                    line = line.strip()
+                    if line:
+                        parts.append(line)
+            if parts:
+                yield header, "".join(parts)
+
+    def indexed_fasta_records(self, input_file: str, wildtype: bool = False):
+        """
+        Generator that yields the (header, sequence) records of an indexed fasta that cropping uses:
+        the first mutant record per lineX (and the wildtype records if wildtype), other sequences are never read.
+        """
+        name = os.path.basename(input_file)
+        lineX_dupes = set()
+        for row in self.fasta_index.load(name):
+            lineX, kind = row[0], row[2]
+            if kind == "WILDTYPE":
+                if not wildtype:
+                    continue
+            elif lineX in lineX_dupes:
+                continue
+            else:
+                lineX_dupes.add(lineX)
+            yield ">" + row[5], self.fasta_index.sequence(name, row)
+
+    def fasta_protein_changes(self, input_file: str, wildtype: bool = False):
+        """
+        Generator that yields a ProteinChange for the first mutant record of every mutation(lineX) in an ANNOVAR fasta,
+        the mutation is parsed from the header. The wildtype protein is only kept if wildtype (otherwise None).
+        """
+        wildtype_sequences = {}  # (lineX, transcript): wildtype sequence
+        # Linex_dupes will keep track of which transcripts have already passed, sometimes there are multiple transcripts(NM...) per mutation(lineX), 
+        # originating from multiple submissions in NCBI.
+        # They should be regarded as equal and skipped.
+        lineX_dupes = set()
+        if self.fasta_index is not None and self.fasta_index.covers(input_file):
+            records = self.indexed_fasta_records(input_file, wildtype)
+        else:
+            records = self.read_fasta_records(input_file)
+        for header, sequence in records:
+            fields = header.split(' ')
+            lineX = fields[0][1:]
+            if "WILDTYPE" in header:
+                # Wildtype records precede the mutant records of the same lineX and transcript
+                if wildtype:
+                    wildtype_sequences[(lineX, fields[1])] = sequence[:-1]
+                continue
+            if lineX in lineX_dupes:
+                continue
+            lineX_dupes.add(lineX)
+            mutation, pos, length = self.parse_header(header)
+            # For compatibility with MHCflurry --> remove last '*'
+            yield ProteinChange(
+                lineX, fields[1], mutation, pos, length, sequence[:-1], wildtype_sequences.get((lineX, fields[1]))
+            )
+
+    def crop_protein_changes(self, sample: str, protein_changes, flank_length: int, wildtype: bool = False):
+        """
+        Generator that lazily yields (header, cropped_sequence, flank, cropped_wildtype) for every unique mutation.
+        protein_changes are ProteinChanges, parsed from an ANNOVAR fasta or from the native coding_change engine.
+        Note: headers are in the form of filename_mutation(lineX)_transcript(NM...) for later identification
+        cropped_wildtype is the wildtype counterpart if wildtype and it can be aligned window by window (SNP), otherwise None.
+        """
+        # Only the first transcript of a mutation(lineX) is used
+        lineX_dupes = set()
+        # To avoid duplicates
+        seen_sequences = set()
+        seen_flanks = set()
+        for change in protein_changes:
+            if change.lineX in lineX_dupes:
+                continue
+            lineX_dupes.add(change.lineX)
+            cropped_sequence, flank = self.crop_sequence(
+                change.sequence, change.pos, flank_length, change.length
+            )
+            cropped_wildtype = None
+            if (
+                wildtype
+                and change.mutation == "snp"
+                and change.wildtype is not None
+                and len(change.wildtype) == len(change.sequence)
+            ):
+                cropped_wildtype = self.crop_sequence(
+                    change.wildtype, change.pos, flank_length, change.length
+                )[0]
+            # !!!! configure "header" to be filename_mutation(lineX)_transcript(NM...) 
+            # --> necessary for identifying in/after MHCflurry
+            header = sample + '_' + change.lineX + '_' + change.transcript
+
+            if (header, cropped_sequence) not in seen_sequences and flank not in seen_flanks:
+                seen_sequences.add((header, cropped_sequence))
+                seen_flanks.add(flank)
+                yield header, cropped_sequence, flank, cropped_wildtype
+
+    def crop_fasta_records(self, input_file: str, flank_length: int, wildtype: bool = False):
+        """
+        Generator that lazily yields (header, cropped_sequence, flank, cropped_wildtype) for every unique mutation in the fasta file.
+        """
+        sample = os.path.basename(input_file).split('.')[0]
+        return self.crop_protein_changes(
+            sample, self.fasta_protein_changes(input_file, wildtype), flank_length, wildtype
+        )
+
+    def process_fasta_file(self, input_file: str, flank_length: int, wildtype: bool = False):
         """
         Function that processes the tumor fasta files and configures the headers from the sequences.
         Note: headers are in the form of filename_mutation(lineX)_transcript(NM...) for later identification
+        If wildtype, the cropped wildtype counterpart of every sequence is returned as well (None if the
+        wildtype can't be aligned window by window, i.e. anything but a SNP).
         """
         try:
-            sequences = []
             cropped_sequences = []
             flanks = []
+            wildtypes = []
+            for header, cropped_sequence, flank, cropped_wildtype in self.crop_fasta_records(
+                input_file, flank_length, wildtype
+            ):
+                cropped_sequences.append((header, cropped_sequence))
+                flanks.append(flank)
+                wildtypes.append(cropped_wildtype)
 
-            with open(input_file, "r") as file:
-                current_sequence = ""
-                current_header = ""
-                for line in file:
-                    if line.startswith(">"):
-                        if current_sequence != "":
-                            sequences.append((current_header, current_sequence))
-                            current_sequence = ""
-                        current_header = line.strip()
-                    else:
-                        current_sequence += line.strip()
-
-                if current_sequence != "":
-                    sequences.append((current_header, current_sequence))
-            # Linex_dupes will keep track of which transcripts have already passed, sometimes there are multiple transcripts(NM...) per mutation(lineX), 
-            # originating from multiple submissions in NCBI.
-            # They should be regarded as equal and skipped.
-            lineX_dupes=[]
-            for header, sequence in sequences:
-                lineX=header.split(' ')[0][1:]
-                if "WILDTYPE" in header or lineX in lineX_dupes:
-                    continue
-                lineX_dupes.append(lineX)
-                mutation, pos, length = self.parse_header(header)
-                # For compatibility with MHCflurry --> remove last '*'
-                sequence = sequence[:-1]
-                cropped_sequence, flank = self.crop_sequence(
-                    sequence, pos, flank_length, length
-                )
-                # !!!! configure "header" to be filename_mutation(lineX)_transcript(NM...) 
-                # --> necessary for identifying in/after MHCflurry
-                header = os.path.basename(input_file).split('.')[0]+'_'+header.split(' ')[0][1:]+'_'+header.split(' ')[1]
-
-                # To avoid duplicates
-                if (header, cropped_sequence) not in cropped_sequences and flank not in flanks:
-                    cropped_sequences.append((header, cropped_sequence))
-                    flanks.append(flank)
-
+            if wildtype:
+                return cropped_sequences, flanks, wildtypes
             return cropped_sequences, flanks
 
         except FileNotFoundError:
@@ -142,23 +236,54 @@ class CroppingFlanksPipeline:
         except Exception as e:
             raise Exception(f"Error processing file: {input_file}") from e
 
-    def cropping_flanks_pipeline_run(self, flank_length: int):
+    def processed_files(self, file_list: list, flank_length: int, wildtype: bool = False):
+        """
+        Generator that yields (file, result) in file order, result() returns the processed file or raises its error.
+        With multiple workers, the files are processed concurrently by a process pool.
+        """
+        if self.workers <= 1 or len(file_list) <= 1:
+            for file in file_list:
+                yield file, partial(self.process_fasta_file, file[0], flank_length, wildtype)
+            return
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(file_list))) as executor:
+            futures = [
+                executor.submit(self.process_fasta_file, file[0], flank_length, wildtype)
+                for file in file_list
+            ]
+            for file, future in zip(file_list, futures):
+                yield file, future.result
+
+    def cropping_flanks_pipeline_run(self, flank_length: int, wildtype: bool = False, protein_changes: dict = None):
         """
         Function that runs all above functions to create the fasta cropping pipeline.
         Note: headers are in the form of filename_mutation(lineX)_transcript(NM...) for later identification
+        If protein_changes ({sample: [ProteinChange,...]} of the native coding_change engine) are given,
+        these are cropped instead of the fastas in the input folder.
         """
         cropped_sequences = []
         flanks = []
+        wildtypes = []
         logging.info("Preparing fasta sequences for MHCflurry...")
 
-        file_list = self.path_handler.file_list(self.path_handler.input_path)
-        for file in file_list:
+        if protein_changes is not None:
+            for sample, changes in protein_changes.items():
+                for header, cropped_sequence, flank, cropped_wildtype in self.crop_protein_changes(
+                    sample, changes, flank_length, wildtype
+                ):
+                    cropped_sequences.append((header, cropped_sequence))
+                    flanks.append(flank)
+                    wildtypes.append(cropped_wildtype)
+            file_list = []
+        else:
+            file_list = self.path_handler.file_list(self.path_handler.input_path)
+        # Results are merged in file order, identical to processing the files one by one
+        for file, result in self.processed_files(file_list, flank_length, wildtype):
             try:
-                processed_sequences, processed_flanks = self.process_fasta_file(
-                    file[0], flank_length
-                )
-                cropped_sequences.extend(processed_sequences)
-                flanks.extend(processed_flanks)
+                processed = result()
+                cropped_sequences.extend(processed[0])
+                flanks.extend(processed[1])
+                if wildtype:
+                    wildtypes.extend(processed[2])
             except Exception as e:
                 logging.error("Error occurred while processing file: %s", file[0])
                 logging.error(str(e))
@@ -166,4 +291,7 @@ class CroppingFlanksPipeline:
         logging.info("Fasta sequences are prepared for MHCflurry!")
         # Returns 2 lists of tuples:
         # [(header,sequence),(header2,sequence2),..], [(left_flank,right_flank),(left_flank2,right_flank2),...]
+        # and if wildtype, a list of cropped wildtype sequences (or None): [wildtype_sequence, None,...]
+        if wildtype:
+            return cropped_sequences, flanks, wildtypes
         return cropped_sequences, flanks
@@ -15,11 +15,28 @@ class CutadaptPipeline:
         self.path_handler = path_handler
         self.command_runner = command_runner
 
+    def cores(self, commands:list) -> int:
+        '''
+        CPUs a cutadapt command uses (-j/--cores), claimed from the command_runner CPU budget. 0 means all CPUs.
+        '''
+        cores = 1
+        for i, command in enumerate(commands):
+            if command in ("-j", "--cores") and i + 1 < len(commands):
+                cores = commands[i + 1]
+            elif command.startswith("--cores="):
+                cores = command.split("=", 1)[1]
+            elif command.startswith("-j") and command[2:].isdigit():
+                cores = command[2:]
+        try:
+            cores = int(cores)
+        except ValueError:
+            return 1
+        return cores if cores > 0 else self.command_runner.cpu_budget
+
     def run_cutadapt_pipeline(self, commands, remove:bool):
         '''
-        Runs the pipeline by using the command_runner for launching a subprocess.
+        Runs the pipeline by submitting a cutadapt command per file to the command_runner scheduler.
         '''
-        processed_files = 0
         commands = [i for i in commands.split(" ")]
         processed_path = self.path_handler.output_subfolder("processed")
         file_list = self.path_handler.file_list(self.path_handler.input_path)
@@ -27,18 +44,20 @@ class CutadaptPipeline:
             f"Processing {len(file_list)} files in {self.path_handler.input_path}"
         )
 
+        cpus = self.cores(commands)
+        futures = {}
         for file in file_list:
             logging.info(f"Starting trimming of {file[1]}")
-            try:
-                outfile = os.path.join(processed_path, file[1])
-                self.command_runner.run(
-                    ["cutadapt"] + commands + ["-o", outfile] + [file[0]]
-                )
-                processed_files += 1
-                logging.info(f"Finished trimming of {file[1]}")
-            except Exception as e:
-                logging.error("Error occurred while trimming file: %s", file[1])
-                logging.error(str(e))
+            outfile = os.path.join(processed_path, file[1])
+            futures[file[1]] = self.command_runner.submit(
+                ["cutadapt"] + commands + ["-o", outfile] + [file[0]],
+                label=file[1],
+                cpus=cpus,
+            )
+        succeeded, failed = self.command_runner.gather(futures)
+        for name in succeeded:
+            logging.info(f"Finished trimming of {name}")
+        processed_files = len(succeeded)
         logging.info(
             f"Finished trimming {processed_files} out of {len(file_list)} files."
         )
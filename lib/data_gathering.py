@@ -3,58 +3,381 @@
 # TRANSCRIPT = NM... (from fasta that is found based on MUTATION)
 # PEPTIDE = the peptide itself, found from header passed to mhcflurry predictions
 
-import pandas as pd
 import os
+import re
 import logging
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lib.m2a import open_maf, MAF_SUFFIXES
+from lib.file_utils import temp_path
+from lib.intern_table import InternTable
+
+# Sequence names (MHCflurry, predictions.csv): SAMPLE_lineX_TRANSCRIPT, transcripts contain "_" themselves (NM_...)
+SEQUENCE_NAME = re.compile(r"^(.*)_(line\d+)_(.*)$")
+
+
+def parse_sequence_name(name: str) -> tuple:
+    """
+    Splits a sequence name into (sample, lineX, transcript).
+    """
+    match = SEQUENCE_NAME.match(name)
+    if match is None:
+        raise ValueError(f"Invalid sequence name: {name}")
+    return match.groups()
+
+
+class TranscriptAlleles(Mapping):
+    """
+    Read-only {SAMPLE_lineX_TRANSCRIPT: [HLA_allele1, HLA_allele2,...]} view of the PipelineData tables,
+    the alleles of a transcript are looked up from its sample so no per-transcript lists are stored.
+    Can be passed as input_alleles to the MHCflurry pipeline like the former dict.
+    """
+
+    def __init__(self, pipeline_data):
+        self.pipeline_data = pipeline_data
+        self.genotypes = {}  # {sample ID: [alleles]}, shared by all transcripts of the sample
+
+    def sample_genotype(self, sample_ID: int):
+        genotype = self.genotypes.get(sample_ID)
+        if genotype is None:
+            genotype = self.genotypes[sample_ID] = self.pipeline_data.sample_genotype(sample_ID)
+        return genotype
+
+    def __getitem__(self, name: str) -> list:
+        try:
+            sample = parse_sequence_name(name)[0]
+        except ValueError:
+            raise KeyError(name)
+        genotype = self.sample_genotype(self.pipeline_data.samples.id(sample))
+        if not genotype:
+            raise KeyError(name)
+        return genotype
+
+    def __iter__(self):
+        pipeline_data = self.pipeline_data
+        columns = pipeline_data.relation("mutation_transcript")
+        for sample, line, transcript in zip(columns["sample"], columns["line"], columns["transcript"]):
+            if self.sample_genotype(sample):
+                yield (
+                    pipeline_data.samples.name(sample) + "_line" + str(line) + "_" + pipeline_data.transcripts.name(transcript)
+                )
+
+    def __len__(self) -> int:
+        pipeline_data = self.pipeline_data
+        allele_samples = np.unique(pipeline_data.relation("sample_allele")["sample"])
+        return int(np.isin(pipeline_data.relation("mutation_transcript")["sample"], allele_samples).sum())
 
 
 class PipelineData:
     """
     This class object serves 2 purposes: saving all analyzed data and performing data gathering functions.
+    Samples, barcodes, transcripts and alleles are interned to integer IDs (InternTable), the relations between them
+    are int32 NumPy columns sorted by sample. The former nested dicts are available as (read-only) views.
     """
 
+    VERSION = 1
+    SIDECAR = "pipeline_data.npz"
+    # Intern table: the relation column holding its IDs
+    TABLES = {"samples": "sample", "barcodes": "barcode", "transcripts": "transcript", "alleles": "allele"}
+    # Relation name: column names, every relation has a sample column and is sorted by it
+    RELATIONS = {
+        "sample_barcode": ("sample", "barcode"),  # HLA_TCGA_ID (Tumor_Sample_Barcode) per sample
+        "sample_allele": ("sample", "allele"),  # HLA alleles per sample
+        "mutation": ("sample", "line"),  # MUTATION = SAMPLE + lineX (line from avinput containing the mutation)
+        "mutation_transcript": ("sample", "line", "transcript"),  # transcripts per mutation (from the fastas)
+    }
+
     def __init__(self, path_handler):
         self.path_handler = path_handler
 
-        self.sample_allele_IDs = (
-            None  # dict: {filename: HLA_TCGA_ID, filename2: HLA_TCGA_ID2,...}
+        self.samples = InternTable()  # filename before any "."
+        self.barcodes = InternTable()  # HLA_TCGA_IDs
+        self.transcripts = InternTable()  # NM...
+        self.alleles = InternTable()  # HLA alleles
+        self.relations = {}  # {relation name: {column name: int32 array}}, only linked relations are present
+        self.relinked = set()  # relations linked in this run that aren't merged with the sidecar yet
+        self.transcript_alleles_linked = False
+
+        # Binary sidecar in the output folder, relations that weren't linked in this run are loaded from it when needed
+        self.sidecar = os.path.join(path_handler.main_output_path, self.SIDECAR)
+        self.loaded = False
+
+    def relation(self, name: str):
+        """
+        Columns of a relation, None if it isn't linked (in this run or an earlier run saved in the sidecar).
+        """
+        if name not in self.relations and not self.loaded:
+            self.load()
+        return self.relations.get(name)
+
+    def save(self):
+        """
+        Saves the tables and relations to the sidecar (pipeline_data.npz), so later stages can run in separate invocations.
+        Relations of earlier runs that weren't linked again are kept, in incremental mode the rows of the unselected samples
+        of relations linked again are kept too.
+        """
+        self.load()
+        arrays = {"version": np.array([self.VERSION])}
+        for table, column in self.TABLES.items():
+            # Names of a table as one "\n" separated UTF-8 byte array
+            arrays["table." + table] = np.frombuffer(
+                "\n".join(getattr(self, table).names).encode(), dtype=np.uint8
+            )
+        for name, columns in self.relations.items():
+            for column, values in columns.items():
+                arrays[name + "." + column] = values
+        arrays["transcript_alleles_linked"] = np.array([self.transcript_alleles_linked])
+        try:
+            temp_file = temp_path(self.sidecar)
+            with open(temp_file, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(temp_file, self.sidecar)
+            logging.info(f"Pipeline data saved to {self.sidecar}")
+        except Exception as e:
+            logging.error(f"{e} in saving pipeline data")
+
+    def load(self):
+        """
+        Loads the relations from the sidecar that aren't linked in this run, their IDs are mapped to the IDs of this run.
+        In incremental mode the relations linked (again) since the last load get the sidecar rows of the unselected samples.
+        """
+        self.loaded = True
+        if not os.path.isfile(self.sidecar):
+            self.relinked.clear()
+            return
+        try:
+            with np.load(self.sidecar) as data:
+                if "version" not in data or int(data["version"][0]) != self.VERSION:
+                    logging.info(f"Ignoring pipeline data of another version in {self.sidecar}")
+                    self.relinked.clear()
+                    return
+                # Sidecar ID --> ID of this run, per column name
+                mappings = {}
+                for table, column in self.TABLES.items():
+                    names = data["table." + table].tobytes().decode()
+                    mappings[column] = getattr(self, table).intern_many(names.split("\n") if names else [])
+                for name, columns in self.RELATIONS.items():
+                    if name + ".sample" not in data:
+                        continue
+                    loaded = {
+                        column: mappings[column][data[name + "." + column]] if column in mappings else data[name + "." + column]
+                        for column in columns
+                    }
+                    if name in self.relinked:
+                        if self.path_handler.sample_filter is None:
+                            continue
+                        # Incremental mode: only the selected samples were linked in this run, the others are kept
+                        selected = np.array([self.path_handler.selected(sample) for sample in self.samples], dtype=bool)
+                        kept = ~selected[loaded["sample"]]
+                        loaded = {
+                            column: np.concatenate((self.relations[name][column], values[kept]))
+                            for column, values in loaded.items()
+                        }
+                    elif name in self.relations:
+                        continue
+                    elif name == "mutation_transcript":
+                        self.transcript_alleles_linked = bool(data["transcript_alleles_linked"][0])
+                    self.set_relation(name, linked=False, **loaded)
+            self.relinked.clear()
+            logging.info(f"Pipeline data loaded from {self.sidecar}")
+        except Exception as e:
+            logging.error(f"{e} in loading pipeline data")
+
+    def set_relation(self, name: str, linked: bool = True, **columns):
+        """
+        Stores a relation from ID columns (lists or arrays), rows are stably sorted by sample.
+        Linked relations (not loaded from the sidecar) are merged with the sidecar at the next save.
+        """
+        columns = {column: np.asarray(columns[column], dtype=np.int32) for column in self.RELATIONS[name]}
+        order = np.argsort(columns["sample"], kind="stable")
+        self.relations[name] = {column: values[order] for column, values in columns.items()}
+        if linked:
+            self.relinked.add(name)
+
+    def sample_rows(self, name: str, sample_ID: int) -> slice:
+        """
+        Rows of a relation belonging to a sample.
+        """
+        samples = self.relation(name)["sample"]
+        return slice(
+            int(np.searchsorted(samples, sample_ID, "left")), int(np.searchsorted(samples, sample_ID, "right"))
+        )
+
+    def join(self, left: str, right: str) -> tuple:
+        """
+        Joins two relations on sample: returns the (left rows, right rows) index columns of all matching pairs.
+        """
+        left_samples = self.relation(left)["sample"]
+        right_samples = self.relation(right)["sample"]
+        starts = np.searchsorted(right_samples, left_samples, "left")
+        counts = np.searchsorted(right_samples, left_samples, "right") - starts
+        left_rows = np.repeat(np.arange(len(left_samples)), counts)
+        offsets = np.cumsum(counts) - counts
+        right_rows = np.arange(counts.sum()) - np.repeat(offsets, counts) + np.repeat(starts, counts)
+        return left_rows, right_rows
+
+    def sample_genotype(self, sample_ID: int) -> list:
+        """
+        HLA alleles of a sample (empty if not linked).
+        """
+        if self.relation("sample_allele") is None or sample_ID < 0:
+            return []
+        return self.alleles.lookup(self.relation("sample_allele")["allele"][self.sample_rows("sample_allele", sample_ID)])
+
+    def set_mutation_counts(self, counts: dict):
+        """
+        Links the samples to their mutations (line1 ... lineN of the avinput) from {sample: amount of mutations}.
+        """
+        samples = self.samples.intern_many(counts)
+        amounts = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+        sample_column = np.repeat(samples, amounts)
+        line_column = np.arange(len(sample_column)) - np.repeat(np.cumsum(amounts) - amounts, amounts) + 1
+        self.set_relation("mutation", sample=sample_column, line=line_column)
+
+    def mutations_by_sample(self):
+        """
+        Yields (sample, [line1, line2,...]) for the database stage.
+        """
+        columns = self.relation("mutation")
+        if columns is None:
+            return
+        samples, starts = np.unique(columns["sample"], return_index=True)
+        ends = list(starts[1:]) + [len(columns["sample"])]
+        for sample, start, end in zip(samples, starts, ends):
+            yield self.samples.name(sample), ["line" + str(line) for line in columns["line"][start:end]]
+
+    def transcript_rows(self):
+        """
+        Yields (sample, lineX, transcript) of all linked transcripts.
+        """
+        columns = self.relation("mutation_transcript") or {}
+        for sample, line, transcript in zip(columns.get("sample", []), columns.get("line", []), columns.get("transcript", [])):
+            yield self.samples.name(sample), "line" + str(line), self.transcripts.name(transcript)
+
+    ## Views and setters of the former dicts
+
+    @property
+    def sample_allele_IDs(self):
+        # dict: {filename: HLA_TCGA_ID, filename2: HLA_TCGA_ID2,...}
+        columns = self.relation("sample_barcode")
+        if columns is None:
+            return None
+        return {self.samples.name(s): self.barcodes.name(b) for s, b in zip(columns["sample"], columns["barcode"])}
+
+    @sample_allele_IDs.setter
+    def sample_allele_IDs(self, sample_allele_IDs: dict):
+        if sample_allele_IDs is None:
+            self.relations.pop("sample_barcode", None)
+            return
+        self.set_relation(
+            "sample_barcode",
+            sample=self.samples.intern_many(sample_allele_IDs),
+            barcode=self.barcodes.intern_many(sample_allele_IDs.values()),
         )
-        self.sample_alleles = None  # dict: {filename:[HLA_allele1, HLA_allele2,...], filename2:[HLA_allele1_1, HLA_allele2_2,...],...}
-        self.sample_mutations = None  # dict: {filename: [line1,line2,line3,...], filename2: [line1_1,line2_2,line3_3,...],...}
-        self.mutation_transcripts = None  # dict: {filename_lineX: [NM...,NM...,NM...], filename_lineX2: [NM...,NM...,NM...],...}
-        self.transcripts_alleles = None  # dict: {filename_lineX_NM: [HLA_allele1, HLA_allele2,...], filename_lineX_NM2: [HLA_allele1, HLA_allele2,...],...}
 
+    @property
+    def sample_alleles(self):
+        # dict: {filename:[HLA_allele1, HLA_allele2,...], filename2:[HLA_allele1_1, HLA_allele2_2,...],...}
+        columns = self.relation("sample_allele")
+        if columns is None:
+            return None
+        sample_alleles = {}
+        for sample, allele in zip(columns["sample"], columns["allele"]):
+            sample_alleles.setdefault(self.samples.name(sample), []).append(self.alleles.name(allele))
+        return sample_alleles
 
-    def link_HLA_ID_TCGA_to_MAF_samples(self):
+    @sample_alleles.setter
+    def sample_alleles(self, sample_alleles: dict):
+        if sample_alleles is None:
+            self.relations.pop("sample_allele", None)
+            return
+        samples, alleles = [], []
+        for sample, sample_allele_list in sample_alleles.items():
+            sample_ID = self.samples.intern(sample)
+            for allele in sample_allele_list:
+                samples.append(sample_ID)
+                alleles.append(self.alleles.intern(allele))
+        self.set_relation("sample_allele", sample=samples, allele=alleles)
+
+    @property
+    def sample_mutations(self):
+        # dict: {filename: [line1,line2,line3,...], filename2: [line1_1,line2_2,line3_3,...],...}
+        if self.relation("mutation") is None:
+            return None
+        return dict(self.mutations_by_sample())
+
+    @sample_mutations.setter
+    def sample_mutations(self, sample_mutations: dict):
+        if sample_mutations is None:
+            self.relations.pop("mutation", None)
+            return
+        samples, lines = [], []
+        for sample, mutations in sample_mutations.items():
+            sample_ID = self.samples.intern(sample)
+            for mutation in mutations:
+                samples.append(sample_ID)
+                lines.append(int(mutation[4:]))
+        self.set_relation("mutation", sample=samples, line=lines)
+
+    @property
+    def mutation_transcripts(self):
+        # dict: {filename_lineX: [NM...,NM...,NM...], filename_lineX2: [NM...,NM...,NM...],...}
+        if self.relation("mutation_transcript") is None:
+            return None
+        mutation_transcripts = {}
+        for sample, lineX, transcript in self.transcript_rows():
+            mutation_transcripts.setdefault(sample + "_" + lineX, []).append(transcript)
+        return mutation_transcripts
+
+    @property
+    def transcripts_alleles(self):
+        # view: {filename_lineX_NM: [HLA_allele1, HLA_allele2,...], filename_lineX_NM2: [HLA_allele1, HLA_allele2,...],...}
+        if self.relation("mutation_transcript") is None or not self.transcript_alleles_linked:
+            return None
+        return TranscriptAlleles(self)
+
+
+    def read_MAF_barcode(self, path: str) -> str:
+        '''
+        Reads the Tumor_Sample_Barcode of the first row of a (gzip compressed) MAF, only the header and first row are read.
+        '''
+        with open_maf(path) as f:
+            header = None
+            for line in f:
+                # Skip lines starting with "#"
+                if line.startswith("#"):
+                    continue
+                if header is None:
+                    header = line.strip().split("\t")
+                    continue
+                return line.strip().split("\t")[header.index("Tumor_Sample_Barcode")]
+        raise ValueError(f"No MAF rows found in {path}")
+
+    def link_HLA_ID_TCGA_to_MAF_samples(self, workers: int = 1):
         '''
         Function to link the HLA_IDs from TCGA to the MAF samples.
+        MAFs in subfolders (GDC download tree) are included, compressed MAFs are read concurrently with multiple workers.
         '''
         sample_allele_IDs = {}
-        file_list = self.path_handler.file_list(
-            self.path_handler.input_path
-        )  # read in .avinput files
-        for file in file_list:
+        file_list = self.path_handler.walk_file_list(
+            self.path_handler.input_path, MAF_SUFFIXES
+        )  # read in .maf(.gz) files
+
+        def read_barcode(file):
             try:
-                # Read the data from the file
-                with open(file[0]) as f:
-                    lines = f.readlines()
-                    # Remove lines starting with "#" and split the remaining lines into columns
-                    data_lines = [
-                        line.strip().split("\t")
-                        for line in lines
-                        if not line.startswith("#")
-                    ]
-
-                    # Extract the header line
-                    header = data_lines[0]
-
-                    # Create a DataFrame from the data lines
-                    df = pd.DataFrame(data_lines[1:], columns=header)
-                    allele = df.loc[0, "Tumor_Sample_Barcode"]
-                    sample = file[1].split(".")[0]
-                    sample_allele_IDs[sample] = allele
+                return self.read_MAF_barcode(file[0])
             except Exception as e:
                 logging.error(f"{e} in link_HLA_ID_TCGA_to_MAF_samples")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for file, allele in zip(file_list, executor.map(read_barcode, file_list)):
+                if allele is not None:
+                    sample = file[1].split(".")[0]
+                    sample_allele_IDs[sample] = allele
         self.sample_allele_IDs = sample_allele_IDs
 
     def link_HLA_TCGA_to_samples(self, HLA_dict: dict):
@@ -81,59 +404,76 @@ class PipelineData:
         '''
         Function to link the samples to the mutations (from AVINPUT).
         '''
-        sample_mutations = {}
+        mutation_counts = {}
         file_list = self.path_handler.file_list(
             self.path_handler.input_path
         )  # read in .avinput files
         for file in file_list:
             try:
                 with open(file[0]) as f:
-                    lines = f.readlines()
                     sample = file[1].split(".")[0]
-                    sample_mutations[sample] = []
-                    for i in range(len(lines)):
-                        sample_mutations[sample].append("line" + str(i + 1))
+                    mutation_counts[sample] = sum(1 for _ in f)
             except Exception as e:
                 logging.error(f"{e} in link_samples_to_mutation_from_avinput")
-        self.sample_mutations = sample_mutations
+        self.set_mutation_counts(mutation_counts)
 
-    def link_mutation_to_transcripts(self):
+    def link_mutation_to_transcripts(self, fasta_index=None):
         '''
         Function to link the mutations from AVINPUT to the transcripts in the fastas.
+        If a FastaIndex is given, indexed fastas are linked from their index instead of scanning the fasta.
         '''
-        mutation_transcripts = {}
+        samples, lines, transcripts = [], [], []
+        linked = set()  # (sample ID, line, transcript ID) already linked
+
+        def add(sample_ID, lineX, transcript):
+            row = (sample_ID, int(lineX[4:]), self.transcripts.intern(transcript))
+            if row not in linked:
+                linked.add(row)
+                samples.append(row[0])
+                lines.append(row[1])
+                transcripts.append(row[2])
+
         file_list = self.path_handler.file_list(self.path_handler.input_path)
         for file in file_list:
             try:
+                sample_ID = self.samples.intern(file[1].split(".")[0])
+                if fasta_index is not None and fasta_index.covers(file[0]):
+                    for lineX, transcript, *_ in fasta_index.load(file[1]):
+                        add(sample_ID, lineX, transcript)
+                    continue
                 with open(file[0], "r") as f:
-                    sample = file[1].split(".")[0]
                     for line in f:
                         if line.startswith(">"):
                             line = line[1:].split(" ")
-                            lineX = line[0]
-                            if sample + "_" + lineX not in mutation_transcripts:
-                                mutation_transcripts[sample + "_" + lineX] = []
-                            transcript = line[1]
-                            if (
-                                transcript
-                                not in mutation_transcripts[sample + "_" + lineX]
-                            ):
-                                mutation_transcripts[sample + "_" + lineX].append(
-                                    transcript
-                                )
+                            add(sample_ID, line[0], line[1])
             except Exception as e:
                 logging.error(f"{e} in link_mutation_to_transcripts")
-        self.mutation_transcripts = mutation_transcripts
+        self.set_relation("mutation_transcript", sample=samples, line=lines, transcript=transcripts)
+
+    def link_mutation_to_protein_changes(self, protein_changes: dict):
+        '''
+        Function to link the mutations to the transcripts of the native coding_change engine ({sample: [ProteinChange,...]}).
+        '''
+        samples, lines, transcripts = [], [], []
+        linked = set()  # (sample ID, line, transcript ID) already linked
+        for sample, changes in protein_changes.items():
+            sample_ID = self.samples.intern(sample)
+            for change in changes:
+                row = (sample_ID, int(change.lineX[4:]), self.transcripts.intern(change.transcript))
+                if row not in linked:
+                    linked.add(row)
+                    samples.append(row[0])
+                    lines.append(row[1])
+                    transcripts.append(row[2])
+        self.set_relation("mutation_transcript", sample=samples, line=lines, transcript=transcripts)
 
     def link_transcript_to_TCGA_HLA_alleles(self):
         '''
         Function to link the transcripts to the HLA alleles from TCGA.
+        The alleles are joined on sample when transcripts_alleles is used, nothing is copied per transcript.
         '''
-        transcript_alleles = {}
-        # Try to keep logical order to benefit MHCflurry linking process efficiency
-        for key, value in self.mutation_transcripts.items():
-            for transcript in value:
-                transcript_alleles[key + "_" + transcript] = self.sample_alleles[
-                    key.split("_")[0]
-                ]
-        self.transcripts_alleles = transcript_alleles
+        transcript_samples = np.unique(self.relation("mutation_transcript")["sample"])
+        missing = np.setdiff1d(transcript_samples, self.relation("sample_allele")["sample"])
+        if len(missing):
+            raise KeyError(f"HLA alleles not linked for samples: {', '.join(self.samples.lookup(missing))}")
+        self.transcript_alleles_linked = True
@@ -2,6 +2,8 @@ import psycopg2
 import logging
 import csv
 
+from lib.data_gathering import parse_sequence_name
+
 # Make sure the database name is LOWERCASE!!
 
 
@@ -216,8 +218,11 @@ class DatabaseOperations:
             # Create a cursor
             cur = conn.cursor()
 
+            # Mutations grouped per sample from the PipelineData tables
+            sample_mutations = list(self.pipeline_data.mutations_by_sample())
+
             # Insert data into the Sample table
-            for sample_name in list(self.pipeline_data.sample_mutations.keys()):
+            for sample_name, _ in sample_mutations:
                 # Check if the sample with the same name already exists
                 cur.execute(
                     "SELECT sample_id FROM Sample WHERE sample_name = %s",
@@ -242,7 +247,7 @@ class DatabaseOperations:
             for (
                 sample_name,
                 mutation_names,
-            ) in self.pipeline_data.sample_mutations.items():
+            ) in sample_mutations:
                 cur.execute(
                     "SELECT sample_id FROM Sample WHERE sample_name = %s",
                     (sample_name,),
@@ -348,7 +353,7 @@ class DatabaseOperations:
 
             # Iterate through the dict and insert the data into the database
             for sample_mutation_transcript, peptide_list in peptide_data.items():
-                sample, mutation, transcript = sample_mutation_transcript.split("_", 2)
+                sample, mutation, transcript = parse_sequence_name(sample_mutation_transcript)
 
                 for peptide_data in peptide_list:
                     (
@@ -0,0 +1,180 @@
+import os
+import mmap
+import logging
+
+from lib.file_utils import temp_path
+
+
+class FastaIndex:
+    """
+    .fai-style on-disk index of the ANNOVAR coding_change fastas (output/fastas), one index file per fasta in output/fasta_index.
+    Every record (lineX, transcript, WILDTYPE or MUTANT) is mapped to the byte offset and length of its sequence,
+    sequences are read through mmap so single records can be fetched without parsing the whole fasta.
+    """
+
+    # Index file format: first line '#fasta_size\tfasta_mtime_ns', then one line per record:
+    # lineX \t transcript \t kind \t offset \t length \t header (without '>')
+    SUFFIX = ".fai"
+
+    def __init__(self, output_path: str):
+        self.index_dir = os.path.join(output_path, "fasta_index")
+        self.fasta_dir = os.path.join(output_path, "fastas")
+        self.rows = {}  # {fasta name: [(lineX, transcript, kind, offset, length, header),...]}
+        self.keys = {}  # {fasta name: {(lineX, transcript, kind): row}}
+        self.maps = {}  # {fasta name: mmap}
+        self.samples = None  # {sample: fasta name} of the indexed fastas, read once by fetch
+
+    def __getstate__(self):
+        # Worker processes map the fastas themselves
+        state = self.__dict__.copy()
+        state["maps"] = {}
+        return state
+
+    def fasta_stamp(self, fasta_file: str) -> str:
+        """
+        Size and modification time of a fasta, an index is only used if these still match.
+        """
+        stat = os.stat(fasta_file)
+        return f"#{stat.st_size}\t{stat.st_mtime_ns}"
+
+    def index_fasta(self, fasta_file: str) -> list:
+        """
+        Scans a fasta once and returns the rows of its index, records without sequence are left out.
+        """
+        rows = []
+        header, start, has_sequence, position = None, 0, False, 0
+
+        def add_row():
+            fields = header.split(" ")
+            kind = "WILDTYPE" if "WILDTYPE" in header else "MUTANT"
+            rows.append(
+                (fields[0], fields[1] if len(fields) > 1 else "", kind, start, position - start, header)
+            )
+
+        with open(fasta_file, "rb") as f:
+            for line in f:
+                if line.startswith(b">"):
+                    if header is not None and has_sequence:
+                        add_row()
+                    header = line[1:].strip().decode()
+                    start, has_sequence = position + len(line), False
+                elif line.strip():
+                    has_sequence = True
+                position += len(line)
+        if header is not None and has_sequence:
+            add_row()
+        return rows
+
+    def build(self, file_list: list):
+        """
+        Builds (or rebuilds) the index files of the given fastas, file_list as returned by PathHandler.file_list.
+        """
+        os.makedirs(self.index_dir, exist_ok=True)
+        records = 0
+        for path, name in file_list:
+            try:
+                rows = self.index_fasta(path)
+                index_file = os.path.join(self.index_dir, name + self.SUFFIX)
+                with open(temp_path(index_file), "w") as f:
+                    f.write(self.fasta_stamp(path) + "\n")
+                    for row in rows:
+                        f.write("\t".join(str(value) for value in row) + "\n")
+                os.replace(temp_path(index_file), index_file)
+                records += len(rows)
+                self.rows.pop(name, None)
+                self.keys.pop(name, None)
+                self.samples = None
+            except Exception as e:
+                logging.error(f"Error occurred while indexing fasta: {name}")
+                logging.error(str(e))
+        logging.info(f"Fasta index built for {len(file_list)} fastas ({records} records) in {self.index_dir}")
+
+    def has(self, name: str) -> bool:
+        """
+        Checks if an up-to-date index exists for a fasta (name as in the fastas folder).
+        """
+        index_file = os.path.join(self.index_dir, name + self.SUFFIX)
+        fasta_file = os.path.join(self.fasta_dir, name)
+        if not os.path.isfile(index_file) or not os.path.isfile(fasta_file):
+            return False
+        with open(index_file, "r") as f:
+            return f.readline().rstrip("\n") == self.fasta_stamp(fasta_file)
+
+    def covers(self, path: str) -> bool:
+        """
+        Checks if a fasta path lies in the indexed fastas folder and has an up-to-date index.
+        """
+        return (
+            os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.fasta_dir)
+            and self.has(os.path.basename(path))
+        )
+
+    def load(self, name: str) -> list:
+        """
+        Reads the index rows of a fasta (once).
+        """
+        if name not in self.rows:
+            rows = []
+            with open(os.path.join(self.index_dir, name + self.SUFFIX), "r") as f:
+                f.readline()
+                for line in f:
+                    lineX, transcript, kind, offset, length, header = line.rstrip("\n").split("\t", 5)
+                    rows.append((lineX, transcript, kind, int(offset), int(length), header))
+            self.rows[name] = rows
+            # First record wins for duplicate keys
+            keys = {}
+            for row in rows:
+                keys.setdefault(row[:3], row)
+            self.keys[name] = keys
+        return self.rows[name]
+
+    def sequence(self, name: str, row: tuple) -> str:
+        """
+        Reads the sequence of an index row from the memory-mapped fasta.
+        """
+        if name not in self.maps:
+            with open(os.path.join(self.fasta_dir, name), "rb") as f:
+                self.maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length = row[3], row[4]
+        return "".join(self.maps[name][offset : offset + length].decode().split())
+
+    def sample_fastas(self) -> dict:
+        """
+        {sample: fasta name} of all indexed fastas, SAMPLE = filename before any "."
+        """
+        if not os.path.isdir(self.index_dir):
+            return {}
+        return {
+            name.split(".")[0]: name[: -len(self.SUFFIX)]
+            for name in sorted(os.listdir(self.index_dir))
+            if name.endswith(self.SUFFIX)
+        }
+
+    def fetch(self, sample: str, lineX: str, transcript: str, wildtype: bool = False):
+        """
+        Fetches a single record: (header, sequence) of the mutant (or wildtype) protein, None if not indexed.
+        The fastas of the samples and their index rows are read once, a lookup is a dict access and an mmap slice.
+        """
+        if self.samples is None:
+            self.samples = self.sample_fastas()
+        name = self.samples.get(sample)
+        if name is None:
+            return None
+        if name not in self.keys:
+            if not self.has(name):
+                # Outdated index: the sample is left out
+                self.samples.pop(sample)
+                return None
+            self.load(name)
+        row = self.keys[name].get((lineX, transcript, "WILDTYPE" if wildtype else "MUTANT"))
+        if row is None:
+            return None
+        return row[5], self.sequence(name, row)
+
+    def close(self):
+        """
+        Closes the memory-mapped fastas.
+        """
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps = {}
@@ -0,0 +1,43 @@
+import os
+
+
+def temp_path(path: str) -> str:
+    '''
+    Hidden temporary file next to an output file (dir/.name.tmp), hidden files are skipped by PathHandler.file_list.
+    It is renamed to the output file once it is complete, so an output file is never partially written.
+    '''
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+
+
+def complete_marker(path: str) -> str:
+    '''
+    Hidden completion marker of an output file that is written in place (dir/.name.complete).
+    '''
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".complete")
+
+
+def mark_incomplete(path: str):
+    '''
+    Removes the completion marker before (re)writing an output file in place.
+    '''
+    if os.path.exists(complete_marker(path)):
+        os.remove(complete_marker(path))
+
+
+def mark_complete(path: str):
+    '''
+    Marks an output file as completely written.
+    '''
+    with open(complete_marker(path), "w") as f:
+        f.write(str(os.path.getsize(path)) + "\n")
+
+
+def is_complete(path: str) -> bool:
+    '''
+    True if the output file exists and has not changed size since it was marked complete.
+    '''
+    try:
+        with open(complete_marker(path), "r") as f:
+            return int(f.read().strip()) == os.path.getsize(path)
+    except (OSError, ValueError):
+        return False
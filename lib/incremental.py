@@ -0,0 +1,241 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import pandas as pd
+
+from lib.m2a import MAF_SUFFIXES
+from lib.file_utils import temp_path, mark_complete, mark_incomplete, is_complete
+
+
+class IncrementalManifest:
+    """
+    Manifest of the samples already processed into an output folder (incremental mode).
+    Stores size, mtime and content hash of every sample's input files and of its avinput and fasta files,
+    so a rerun only pushes new or changed samples through the pipeline and merges their predictions.
+    Files are only hashed again when their size or mtime changed.
+    """
+
+    VERSION = 2
+    # Output subfolders whose files are tracked per sample
+    TRACKED_FOLDERS = ["avinput_files", "fastas"]
+
+    def __init__(self, path_handler):
+        self.path_handler = path_handler
+        self.manifest_file = os.path.join(
+            path_handler.main_output_path, "incremental_manifest.json"
+        )
+        # {sample: {"input": {filename: [size, mtime_ns, sha256]}, "outputs": {folder/filename: [size, mtime_ns, sha256]},
+        #           "derived": [samples split from it]}}
+        self.samples = {}
+        self.inputs = {}  # input files of the current run, {sample: {filename: [size, mtime_ns, sha256]}}
+        self.changed = set()
+        self.derived = {}  # {input sample: {samples split from it}} (--m2a_split_samples)
+        self.predictions_complete = True  # False if the predictions of the changed samples are incomplete
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == self.VERSION:
+                self.samples = manifest["samples"]
+            elif manifest.get("version") == 1:
+                # Hash-only records: every file is hashed once more to record its size and mtime
+                self.samples = {
+                    sample: {
+                        kind: {name: [None, None, digest] for name, digest in entry[kind].items()}
+                        for kind in ("input", "outputs")
+                    }
+                    for sample, entry in manifest["samples"].items()
+                }
+            else:
+                logging.info("Incremental manifest is outdated, processing all samples.")
+
+    @staticmethod
+    def sample_name(filename: str) -> str:
+        """
+        SAMPLE = filename before any "."
+        """
+        return filename.split(".")[0]
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+        """
+        SHA-256 of the file contents.
+        """
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def file_record(self, path: str, previous: list = None) -> list:
+        """
+        [size, mtime_ns, sha256] of a file, the hash of the previous record is reused if size and mtime are unchanged.
+        """
+        stat = os.stat(path)
+        if previous is not None and previous[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return previous
+        return [stat.st_size, stat.st_mtime_ns, self.file_hash(path)]
+
+    def outputs_intact(self, outputs: dict) -> bool:
+        """
+        Checks if the tracked output files of a sample are still on disk and unchanged.
+        Records of files that were only touched get their new size and mtime.
+        """
+        for relative_path, record in outputs.items():
+            path = os.path.join(self.path_handler.main_output_path, relative_path)
+            if not os.path.isfile(path):
+                return False
+            current = self.file_record(path, record)
+            if current[2] != record[2]:
+                return False
+            outputs[relative_path] = current
+        return True
+
+    def changed_samples(self) -> set:
+        """
+        Samples in the input that are new, changed, or whose tracked outputs were removed or modified.
+        Returns a copy, the caller may extend it (e.g. with split samples) without changing the recorded samples.
+        """
+        inputs = {}
+        for path, name in self.path_handler.walk_file_list(self.path_handler.main_input_path, MAF_SUFFIXES):
+            if os.path.isfile(path):
+                sample = self.sample_name(name)
+                previous = self.samples.get(sample, {}).get("input", {}).get(name)
+                inputs.setdefault(sample, {})[name] = self.file_record(path, previous)
+        changed = set()
+        for sample, files in inputs.items():
+            entry = self.samples.get(sample)
+            if (
+                entry is None
+                or {name: record[2] for name, record in entry["input"].items()}
+                != {name: record[2] for name, record in files.items()}
+                or not self.outputs_intact(entry["outputs"])
+            ):
+                changed.add(sample)
+            else:
+                entry["input"] = files
+        self.inputs = inputs
+        self.changed = changed
+        logging.info(
+            f"Incremental mode: {len(changed)} new or changed samples out of {len(inputs)}."
+        )
+        return set(changed)
+
+    def add_derived_samples(self, sources: dict):
+        """
+        Registers the samples split from an input (e.g. the barcodes of a cohort MAF, {input sample: [samples]}),
+        their output files are tracked as outputs of the input sample.
+        """
+        for sample, derived in sources.items():
+            self.derived.setdefault(sample, set()).update(derived)
+
+    def replaced_samples(self) -> set:
+        """
+        Samples whose previous predictions are replaced: the changed samples and the samples split from them,
+        in this run or (no longer present) in the run that recorded them.
+        """
+        samples = set(self.changed)
+        for sample in self.changed:
+            samples |= self.derived.get(sample, set())
+            samples |= set(self.samples.get(sample, {}).get("derived", []))
+        return samples
+
+    def sample_outputs(self, sample: str) -> dict:
+        """
+        Records of the files of a sample (and the samples split from it) in the tracked output subfolders.
+        """
+        samples = {sample} | self.derived.get(sample, set())
+        outputs = {}
+        for folder in self.TRACKED_FOLDERS:
+            path = os.path.join(self.path_handler.main_output_path, folder)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if self.sample_name(name) in samples and not name.startswith("."):
+                    outputs[os.path.join(folder, name)] = self.file_record(os.path.join(path, name))
+        return outputs
+
+    def save(self):
+        """
+        Records the processed samples of this run and writes the manifest (atomically),
+        the refreshed size and mtime of unchanged files are saved as well.
+        Samples with incomplete predictions aren't recorded, they are processed again in the next run.
+        """
+        if not self.predictions_complete:
+            logging.warning("Predictions are incomplete, the changed samples are processed again in the next run.")
+        for sample in self.changed if self.predictions_complete else ():
+            self.samples[sample] = {
+                "input": self.inputs[sample],
+                "outputs": self.sample_outputs(sample),
+                "derived": sorted(self.derived.get(sample, set())),
+            }
+        temp_file = temp_path(self.manifest_file)
+        with open(temp_file, "w") as f:
+            json.dump({"version": self.VERSION, "samples": self.samples}, f, indent=1)
+        os.replace(temp_file, self.manifest_file)
+        logging.info(f"Incremental manifest updated: {len(self.samples)} samples processed.")
+
+    def stash_predictions(self):
+        """
+        Moves the existing predictions aside before MHCflurry writes the predictions of the changed samples.
+        """
+        outfile = os.path.join(self.path_handler.main_output_path, "predictions.csv")
+        if os.path.isfile(outfile):
+            mark_incomplete(outfile)
+            os.replace(outfile, outfile[:-4] + ".previous.csv")
+
+    def merge_predictions(self, chunk_size: int = 100000):
+        """
+        Merges the predictions of the changed samples into the previous predictions:
+        previous rows of the changed samples (and the samples split from them) are replaced, all other rows are kept.
+        The new rows are kept as predictions.delta.csv, which becomes the input for the next steps (e.g. store_db).
+        Predictions without a completion marker are incomplete: they are kept as predictions.partial.csv
+        and the previous predictions are restored.
+        """
+        outfile = os.path.join(self.path_handler.main_output_path, "predictions.csv")
+        previous_file = outfile[:-4] + ".previous.csv"
+        delta_file = outfile[:-4] + ".delta.csv"
+        if not is_complete(outfile):
+            # Prediction failed, keep the previous predictions
+            self.predictions_complete = False
+            if os.path.isfile(outfile):
+                partial_file = outfile[:-4] + ".partial.csv"
+                os.replace(outfile, partial_file)
+                logging.warning(f"Incomplete predictions kept in {partial_file}")
+            if os.path.isfile(previous_file):
+                os.replace(previous_file, outfile)
+                mark_complete(outfile)
+            return
+        if not os.path.isfile(previous_file):
+            shutil.copyfile(outfile, delta_file)
+            self.path_handler.update_input(delta_file)
+            return
+
+        delta = pd.read_csv(outfile)
+        columns = list(delta.columns)
+        next_peptide_num = 0
+        replaced = self.replaced_samples()
+        temp_file = temp_path(outfile)
+        with open(temp_file, "w") as out:
+            header = True
+            for chunk in pd.read_csv(previous_file, chunksize=chunk_size):
+                columns += [column for column in chunk.columns if column not in columns]
+                if "peptide_num" in chunk.columns and len(chunk):
+                    next_peptide_num = max(next_peptide_num, int(chunk["peptide_num"].max()) + 1)
+                samples = chunk["sequence_name"].astype(str).str.extract(r"^(.*)_line\d+_", expand=False)
+                chunk = chunk[~samples.isin(replaced)]
+                out.write(chunk.reindex(columns=columns).to_csv(index=False, header=header))
+                header = False
+            if "peptide_num" in delta.columns:
+                # Keep peptide_num unique over the merged predictions
+                delta["peptide_num"] += next_peptide_num
+            out.write(delta.reindex(columns=columns).to_csv(index=False, header=header))
+        delta.to_csv(delta_file, index=False)
+        os.replace(temp_file, outfile)
+        mark_complete(outfile)
+        os.remove(previous_file)
+        logging.info(
+            f"Merged {len(delta)} new predictions of {len(self.changed)} samples into {outfile}."
+        )
+        self.path_handler.update_input(delta_file)
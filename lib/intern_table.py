@@ -0,0 +1,54 @@
+import numpy as np
+
+
+class InternTable:
+    """
+    Interns names (samples, transcripts, alleles,...) to consecutive integer IDs, every name is stored once.
+    Relations between the names are kept as integer (NumPy) columns of these IDs.
+    """
+
+    def __init__(self, names=()):
+        self.names = []  # [name of ID 0, name of ID 1,...]
+        self.ids = {}  # {name: ID}
+        for name in names:
+            self.intern(name)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name) -> bool:
+        return name in self.ids
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def intern(self, name: str) -> int:
+        """
+        Returns the ID of a name, new names get the next ID.
+        """
+        ID = self.ids.get(name)
+        if ID is None:
+            ID = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return ID
+
+    def intern_many(self, names) -> np.ndarray:
+        """
+        Interns all names, returns their IDs as int32 column.
+        """
+        return np.fromiter((self.intern(name) for name in names), dtype=np.int32)
+
+    def id(self, name: str, default: int = -1) -> int:
+        """
+        ID of a name without interning it (default if unknown).
+        """
+        return self.ids.get(name, default)
+
+    def name(self, ID: int) -> str:
+        return self.names[ID]
+
+    def lookup(self, IDs) -> list:
+        """
+        Names of a column of IDs.
+        """
+        return [self.names[ID] for ID in IDs]
@@ -1,7 +1,38 @@
 #!/usr/bin/env python
 
 import os
+import gzip
 import logging
+from operator import itemgetter
+import shutil
+from itertools import repeat
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.file_utils import temp_path
+
+# MAF files in (subfolders of) the input, GDC downloads are gzip compressed
+MAF_SUFFIXES = (".maf", ".maf.gz")
+
+
+def open_maf(path: str):
+    '''
+    Opens a MAF as a text stream, gzip/bgzip compressed MAFs are decompressed while reading.
+    '''
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    if compressed:
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+
+def avinput_name(maf_name: str) -> str:
+    '''
+    Name of the avinput file of a MAF (sample.maf or sample.maf.gz --> sample.avinput).
+    '''
+    if maf_name.endswith(".gz"):
+        maf_name = maf_name[:-3]
+    return maf_name[:-4] + ".avinput"
 
 
 ## Some of the MAF input lines have missing tabs, this doesn't seem to be a problem in avinput format for ANNOVAR so they are retained.
@@ -10,8 +41,20 @@ class MAFtoAVInputConverter:
     '''
     Pipeline for converting MAF files to AVInput (format for annovar)
     '''
-    def __init__(self, path_handler):
+    def __init__(
+        self,
+        path_handler,
+        chunk_size: int = 1 << 24,
+        workers: int = 1,
+        split_samples: bool = False,
+        max_open_files: int = 64,
+    ):
         self.path_handler = path_handler
+        self.chunk_size = chunk_size  # Bytes of MAF lines converted per chunk
+        self.workers = workers  # Worker processes converting (and decompressing) files in parallel
+        self.split_samples = split_samples  # Split (cohort) MAFs into one avinput per Tumor_Sample_Barcode
+        self.split_sources = {}  # {MAF sample: [samples split from it]}, filled in split mode
+        self.max_open_files = max_open_files  # Open avinputs while splitting
     
     def get_indices(self, head:list):
         cols = [
@@ -29,93 +72,241 @@ class MAFtoAVInputConverter:
             indices = []
         return indices
 
+    def read_header(self, maf) -> list:
+        '''
+        Reads up to the header of a MAF stream, lines starting with "#" are skipped. Returns None for an empty MAF.
+        '''
+        for line in maf:
+            if not line.startswith("#"):
+                return line.split("\t")
+        return None
+
+    def barcode_index(self, head: list):
+        '''
+        Index of the Tumor_Sample_Barcode column, None if missing.
+        '''
+        head = [col.rstrip("\r\n") for col in head]
+        if "Tumor_Sample_Barcode" in head:
+            return head.index("Tumor_Sample_Barcode")
+        return None
+
+    def annovar_line(self, chrom: str, start: str, end: str, ref: str, t1: str, t2: str) -> str:
+        '''
+        Creates the avinput line of a MAF row.
+        '''
+        # An insertion resulting in frameshift uses different conventions in ANNOVAR --> start and end must be the same (pos left of insertion)
+        if (
+            t1 == "-"
+            and t2 != "-"
+            and start.isdigit()
+            and end.isdigit()
+            and int(start) < int(end)
+        ):
+            end = start
+        return "\t".join([chrom, start, end, ref, t2 if ref == t1 else t1, "\n"])
+
+    def write_avinput(self, maf, outfile):
+        '''
+        The MAF is read in chunks of lines, every line is only split up to the last needed column
+        and the avinput lines of a chunk are written at once.
+        Returns the Tumor_Sample_Barcode of the first row (None if missing) and the amount of mutations (avinput lines).
+        '''
+        barcode, mutations = None, 0
+        head = self.read_header(maf)
+        if head is None:
+            return barcode, mutations
+        barcode_index = self.barcode_index(head)
+        indices = self.get_indices(head)
+        # Chromosome, Start_Position, End_Position, Reference_Allele, Tumor_Seq_Allele1, Tumor_Seq_Allele2
+        get_columns = itemgetter(*indices)
+        max_split = max(indices) + 1
+
+        while True:
+            lines = maf.readlines(self.chunk_size)
+            if not lines:
+                break
+            annovar_lines = []
+            for line in lines:
+                if line.startswith("#"):
+                    continue
+                if barcode is None and barcode_index is not None and mutations == 0:
+                    barcode = line.strip().split("\t")[barcode_index]
+                annovar_lines.append(
+                    self.annovar_line(*get_columns(line.split("\t", max_split)))
+                )
+            outfile.write("".join(annovar_lines))
+            mutations += len(annovar_lines)
+        return barcode, mutations
+
     def maf_2_avinput(self, file:str, output_dir:str):
         '''
         Conversion function
+        The avinput is written to a temporary file that only replaces the avinput when the conversion succeeded,
+        a failed conversion leaves no (partial) avinput behind.
+        Returns the Tumor_Sample_Barcode of the first row (None if missing) and the amount of mutations (avinput lines),
+        so the MAF doesn't have to be read again for linking the samples.
         '''
-        outfile_path = os.path.join(output_dir, file[1][:-4] + ".avinput")
+        outfile_path = os.path.join(output_dir, avinput_name(file[1]))
+        try:
+            with open_maf(file[0]) as maf, open(temp_path(outfile_path), "w") as outfile:
+                barcode, mutations = self.write_avinput(maf, outfile)
+            os.replace(temp_path(outfile_path), outfile_path)
+        except Exception as e:
+            error_message = f"Error occurred while converting {file[1]} to AVINPUT: {str(e)}"
+            logging.error(error_message)
+            # The avinput of an earlier run would be mistaken for the result of this MAF
+            self.remove_files([temp_path(outfile_path), outfile_path])
+            raise
+        return barcode, mutations
 
+    def split_maf_2_avinput(self, file:str, output_dir:str, mutations:dict=None) -> dict:
+        '''
+        Streaming splitter for cohort MAFs (e.g. the TCGA mc3 MAF): the rows are grouped by Tumor_Sample_Barcode
+        and converted to one avinput per sample (barcode.avinput) in a single pass over the MAF.
+        At most max_open_files avinputs are open at once, the least recently used one is closed (and appended to later).
+        The avinputs are written to temporary files and only moved into place (or appended to the avinput of an earlier MAF)
+        when the whole MAF was split.
+        Returns {sample: amount of mutations}, mutations of earlier MAFs can be passed to continue their avinputs.
+        '''
+        mutations = {} if mutations is None else mutations
+        file_mutations = {}  # Mutations of this MAF
+        handles = OrderedDict()
         try:
-            with open(file[0], "r") as maf, open(outfile_path, "w") as outfile:
-                head = None
-                for line in maf:
-                    if line.startswith("#"):
-                        continue
-
-                    items = line.split("\t")
-                    if not head:
-                        head = items
-                        col_titles = [
-                            "col_chrom",
-                            "col_start",
-                            "col_end",
-                            "col_ref",
-                            "col_t1",
-                            "col_t2",
-                        ]
-                        col_indices = self.get_indices(head)
-                        pairs = {}
-                        for n, i in enumerate(col_titles):
-                            pairs[i] = col_indices[n]
-                        continue
-
-                    if items[pairs["col_ref"]] == items[pairs["col_t1"]]:
-                        var_allele = pairs["col_t2"]
-                    else:
-                        var_allele = pairs["col_t1"]
-
-                    # An insertion resulting in frameshift uses different conventions in ANNOVAR --> start and end must be the same (pos left of insertion)
-                    if (
-                        items[pairs["col_start"]] < items[pairs["col_end"]]
-                        and items[pairs["col_t1"]] == "-"
-                        and items[pairs["col_t2"]] != "-"
-                    ):
-                        items[pairs["col_end"]] = items[pairs["col_start"]]
-
-                    annovar_line = "\t".join(
-                        [
-                            items[pairs["col_chrom"]],
-                            items[pairs["col_start"]],
-                            items[pairs["col_end"]],
-                            items[pairs["col_ref"]],
-                            items[var_allele],
-                            "\n",
-                        ]
-                    )
+            with open_maf(file[0]) as maf:
+                head = self.read_header(maf)
+                if head is None:
+                    return mutations
+                indices = self.get_indices(head)
+                barcode_index = self.barcode_index(head)
+                if barcode_index is None:
+                    raise ValueError("Tumor_Sample_Barcode column not found")
+                # Chromosome, Start_Position, End_Position, Reference_Allele, Tumor_Seq_Allele1, Tumor_Seq_Allele2, Tumor_Sample_Barcode
+                get_columns = itemgetter(*indices, barcode_index)
+                max_split = max(indices + [barcode_index]) + 1
+
+                while True:
+                    lines = maf.readlines(self.chunk_size)
+                    if not lines:
+                        break
+                    # Group the chunk per sample, every avinput is written once per chunk
+                    samples = {}
+                    for line in lines:
+                        if line.startswith("#"):
+                            continue
+                        *columns, barcode = get_columns(line.split("\t", max_split))
+                        samples.setdefault(barcode.strip(), []).append(self.annovar_line(*columns))
+                    for sample, annovar_lines in samples.items():
+                        handle = handles.pop(sample, None)
+                        if handle is None:
+                            if len(handles) >= self.max_open_files:
+                                handles.popitem(last=False)[1].close()
+                            handle = open(
+                                temp_path(os.path.join(output_dir, sample + ".avinput")),
+                                "a" if sample in file_mutations else "w",
+                            )
+                        handles[sample] = handle
+                        handle.write("".join(annovar_lines))
+                        file_mutations[sample] = file_mutations.get(sample, 0) + len(annovar_lines)
 
-                    outfile.write(annovar_line)
+            for handle in handles.values():
+                handle.close()
+            for sample, amount in file_mutations.items():
+                outfile_path = os.path.join(output_dir, sample + ".avinput")
+                if sample in mutations:
+                    # Sample also in an earlier MAF: continue its avinput
+                    with open(temp_path(outfile_path), "r") as temp, open(outfile_path, "a") as outfile:
+                        shutil.copyfileobj(temp, outfile)
+                    os.remove(temp_path(outfile_path))
+                else:
+                    os.replace(temp_path(outfile_path), outfile_path)
+                mutations[sample] = mutations.get(sample, 0) + amount
 
         except Exception as e:
-            error_message = f"Error occurred while converting {file[1]} to AVINPUT: {str(e)}"
+            error_message = f"Error occurred while splitting {file[1]} to AVINPUT: {str(e)}"
             logging.error(error_message)
+            for handle in handles.values():
+                handle.close()
+            self.remove_files(
+                [temp_path(os.path.join(output_dir, sample + ".avinput")) for sample in set(file_mutations) | set(handles)]
+            )
             raise
+        return mutations
 
-    def run_pipeline(self):
+    def remove_files(self, paths:list):
         '''
-        Function that runs the conversion pipeline
+        Removes the given files if they exist.
         '''
-        converted_files=[]
-        file_list = self.path_handler.file_list(self.path_handler.input_path)
-        output_dir = self.path_handler.output_subfolder("avinput_files")
-        for file in file_list:
-            logging.info("Converting MAF to AVInput for file: %s", file[1])
-            try:
-                self.maf_2_avinput(file, output_dir)
-                converted_files.append(file[1][:-4] + ".avinput")
-                logging.info("Conversion completed for file: %s", file[1])
-            except Exception as e:
-                continue
-
-        # Remove any incomplete files after the loop
-        for file in os.listdir(output_dir):
+        for path in paths:
             try:
-                if file not in converted_files:
-                    os.remove(os.path.join(output_dir, file))
+                if os.path.exists(path):
+                    os.remove(path)
             except Exception as e:
-                logging.error("Error occurred while removing file: %s", file)
+                logging.error("Error occurred while removing file: %s", path)
                 logging.error(str(e))
 
+    def convert_file(self, file:str, output_dir:str):
+        '''
+        Converts a single MAF (in a worker process), returns (avinput name, barcode, mutations) or None if it failed.
+        '''
+        logging.info("Converting MAF to AVInput for file: %s", file[1])
+        try:
+            barcode, mutations = self.maf_2_avinput(file, output_dir)
+            logging.info("Conversion completed for file: %s", file[1])
+            return avinput_name(file[1]), barcode, mutations
+        except Exception as e:
+            return None
+
+    def run_pipeline(self, pipeline_data=None):
+        '''
+        Function that runs the conversion pipeline
+        If pipeline_data is given, the sample barcodes (sample_allele_IDs) and mutations (sample_mutations)
+        are linked in the same pass over the MAFs.
+        '''
+        file_list = self.path_handler.walk_file_list(self.path_handler.input_path, MAF_SUFFIXES)
+        output_dir = self.path_handler.output_subfolder("avinput_files")
+
+        if self.split_samples:
+            # One avinput per sample (barcode) over all MAFs, the barcode is the sample name
+            mutations = {}
+            for file in file_list:
+                logging.info("Splitting MAF into AVInputs per sample for file: %s", file[1])
+                previous = dict(mutations)
+                try:
+                    self.split_maf_2_avinput(file, output_dir, mutations)
+                    self.split_sources.setdefault(file[1].split(".")[0], []).extend(
+                        sample for sample, amount in mutations.items() if amount != previous.get(sample, 0)
+                    )
+                    logging.info("Splitting completed for file: %s", file[1])
+                except Exception as e:
+                    continue
+            converted = [(sample + ".avinput", sample, amount) for sample, amount in mutations.items()]
+            if self.path_handler.sample_filter is not None:
+                # Incremental mode: the samples of the (changed) cohort MAFs are processed further
+                self.path_handler.sample_filter |= set(mutations)
+        elif self.workers > 1:
+            # Every file is converted (and decompressed) in its own worker process
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = executor.map(self.convert_file, file_list, repeat(output_dir))
+                converted = [result for result in results if result is not None]
+        else:
+            results = (self.convert_file(file, output_dir) for file in file_list)
+            converted = [result for result in results if result is not None]
+
+        if pipeline_data is not None:
+            sample_allele_IDs, mutation_counts = {}, {}
+            for name, barcode, mutations in converted:
+                sample = name.split(".")[0]
+                if barcode is not None:
+                    sample_allele_IDs[sample] = barcode
+                else:
+                    logging.error(f"Tumor_Sample_Barcode not found for {sample}")
+                # MUTATION = SAMPLE + lineX (line from avinput containing the mutation)
+                mutation_counts[sample] = mutations
+            pipeline_data.sample_allele_IDs = sample_allele_IDs
+            pipeline_data.set_mutation_counts(mutation_counts)
+
+        # Avinputs are only moved into place when complete, failed conversions leave nothing to clean up
         logging.info(
-            f"MAF to AVINPUT conversion completed for {len(os.listdir(output_dir))} out of {len(file_list)} files."
+            f"MAF to AVINPUT conversion completed for {len(converted)} out of {len(file_list)} files."
         )
         self.path_handler.update_input(output_dir)
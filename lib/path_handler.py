@@ -20,6 +20,14 @@ class PathHandler:
         self.input_path = os.path.abspath(input_path)
         self.output_path = os.path.abspath(output_path)
 
+        self.sample_filter = None  # set of samples (filename before any "."), only these are listed if set
+
+    def selected(self, filename:str)->bool:
+        '''
+        Checks if a file belongs to the selected samples (always True without sample filter).
+        '''
+        return self.sample_filter is None or filename.split(".")[0] in self.sample_filter
+
     def output_subfolder(self,dir_name:str)->str:
         '''
         Output subfolder will be returned and created if it doesn't exist.
@@ -39,12 +47,30 @@ class PathHandler:
             sys.exit(1)
         elif os.path.isdir(path):
             dir_list = os.listdir(path)
-            dir_list = [(os.path.join(path,x),x) for x in dir_list if not x.startswith(".")]
+            dir_list = [(os.path.join(path,x),x) for x in dir_list if not x.startswith(".") and self.selected(x)]
             logging.info(f"Processing {len(dir_list)} files in '{path}'")
             return dir_list
         elif os.path.isfile(path):
             return [(path, os.path.basename(path))]
     
+    def walk_file_list(self,path:str,suffixes:tuple)->list:
+        '''
+        Returns list of tuples containing paths and filenames of all files, like file_list.
+        Subfolders (e.g. a GDC download tree) are walked recursively for files ending with one of the suffixes.
+        '''
+        file_list = [x for x in self.file_list(path) if not os.path.isdir(x[0])]
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(x for x in dirs if not x.startswith("."))
+                if root == path:
+                    continue
+                file_list.extend(
+                    (os.path.join(root,x),x) for x in sorted(files)
+                    if x.endswith(suffixes) and not x.startswith(".") and self.selected(x)
+                )
+            logging.info(f"Found {len(file_list)} files in '{path}' and its subfolders")
+        return file_list
+
     def update_input(self,path:str):
         '''
         Update the general input path.
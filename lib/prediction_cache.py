@@ -0,0 +1,144 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+
+
+class PredictionCache:
+    """
+    Persistent on-disk cache (SQLite) for MHCflurry presentation predictions.
+    Entries are content-addressed by (peptide, n_flank, c_flank, alleles, model version),
+    the least recently used entries are evicted when the cache grows past max_entries.
+    """
+
+    # Predicted columns that are stored per entry, in this order
+    COLUMNS = [
+        "affinity",
+        "best_allele",
+        "processing_score",
+        "presentation_score",
+        "presentation_percentile",
+    ]
+    # SQLite limits the amount of variables per query
+    QUERY_SIZE = 900
+
+    def __init__(self, path: str, model_version: str, max_entries: int = 10000000):
+        self.path = os.path.abspath(path)
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.entries = None
+        self.conn = None
+
+    def __getstate__(self):
+        # Worker processes open their own connection
+        state = self.__dict__.copy()
+        state["conn"] = None
+        return state
+
+    def connect(self):
+        """
+        Opens (and creates if needed) the cache database.
+        """
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=60)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS predictions (
+                    key BLOB PRIMARY KEY,
+                    affinity REAL,
+                    best_allele TEXT,
+                    processing_score REAL,
+                    presentation_score REAL,
+                    presentation_percentile REAL,
+                    last_used INTEGER
+                )
+                """
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)"
+            )
+            self.conn.commit()
+            self.entries = self.conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        return self.conn
+
+    def keys(self, peptides: list, n_flanks: list, c_flanks: list, alleles) -> list:
+        """
+        Content-addressed keys for the given peptides, flanks and alleles (genotype).
+        """
+        suffix = "\t" + ",".join(alleles) + "\t" + self.model_version
+        return [
+            hashlib.sha256(
+                (peptide + "\t" + n_flank + "\t" + c_flank + suffix).encode()
+            ).digest()
+            for peptide, n_flank, c_flank in zip(peptides, n_flanks, c_flanks)
+        ]
+
+    def get(self, keys: list) -> dict:
+        """
+        Returns {key: row} for all keys found in the cache, rows follow COLUMNS.
+        """
+        conn = self.connect()
+        found = {}
+        for start in range(0, len(keys), self.QUERY_SIZE):
+            chunk = keys[start : start + self.QUERY_SIZE]
+            query = f"SELECT key, {', '.join(self.COLUMNS)} FROM predictions WHERE key IN ({','.join('?' * len(chunk))})"
+            for row in conn.execute(query, chunk):
+                # SQLite stores NaN as NULL
+                found[row[0]] = tuple(
+                    float("nan") if value is None and column != "best_allele" else value
+                    for column, value in zip(self.COLUMNS, row[1:])
+                )
+        if found:
+            now = time.time_ns()
+            conn.executemany(
+                "UPDATE predictions SET last_used = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+            conn.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, keys: list, rows: list):
+        """
+        Stores the predicted rows (following COLUMNS) under their keys and evicts old entries if needed.
+        """
+        conn = self.connect()
+        now = time.time_ns()
+        conn.executemany(
+            f"INSERT OR REPLACE INTO predictions (key, {', '.join(self.COLUMNS)}, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(key, *row, now) for key, row in zip(keys, rows)],
+        )
+        conn.commit()
+        self.entries += len(keys)
+        if self.entries > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache holds 90% of max_entries.
+        """
+        conn = self.connect()
+        self.entries = conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        excess = self.entries - int(self.max_entries * 0.9)
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            conn.commit()
+            self.entries -= excess
+            logging.info(f"Evicted {excess} entries from prediction cache {self.path}")
+
+    def close(self):
+        """
+        Closes the connection to the cache database.
+        """
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,129 @@
+import os
+import json
+import logging
+import numpy as np
+
+from lib.reference import reference_proteins, source_manifest, manifest_is_current
+from lib.file_utils import temp_path
+
+# Residue codes, 0 marks separators and non-standard residues
+_RESIDUES = "ACDEFGHIKLMNPQRSTVWY"
+_CODES = np.zeros(256, dtype=np.uint8)
+for _code, _residue in enumerate(_RESIDUES, start=1):
+    _CODES[ord(_residue)] = _code
+
+
+def _multiplier(k: int) -> np.uint64:
+    # 5 bits per residue packs k-mers up to 12 exactly in 64 bits, longer k-mers use a 64-bit polynomial hash
+    return np.uint64(32) if k <= 12 else np.uint64(0x9E3779B97F4A7C15)
+
+
+def _kmer_hashes(codes: np.ndarray, k: int) -> np.ndarray:
+    """
+    Hashes of all k-mers in a code array, k-mers containing a 0 code are removed.
+    """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64)
+    multiplier = _multiplier(k)
+    hashes = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        hashes = hashes * multiplier + codes[j : j + n]
+    invalid = np.concatenate(([0], np.cumsum(codes == 0)))
+    return hashes[invalid[k:] - invalid[:n] == 0]
+
+
+class ProteomeIndex:
+    """
+    Memory-mapped k-mer index (lengths 8-14) of the translated reference proteome (ANNOVAR refGeneMrna).
+    Built once next to the mRNA fasta and versioned, used to drop self-peptides before prediction.
+    """
+
+    VERSION = 2  # 2: transcripts whose refGene locus is ambiguous are left out
+    LENGTHS = range(8, 15)
+
+    def __init__(self, refgene_path: str, mrna_path: str, index_dir: str = None):
+        self.refgene_path = os.path.abspath(refgene_path)
+        self.mrna_path = os.path.abspath(mrna_path)
+        self.index_dir = os.path.abspath(index_dir or self.mrna_path + ".kmers")
+        self.kmers = None
+
+    def __getstate__(self):
+        # Worker processes map the index themselves
+        state = self.__dict__.copy()
+        state["kmers"] = None
+        return state
+
+    def manifest(self) -> dict:
+        """
+        Version and source file stamps the index was built from.
+        """
+        return source_manifest(self.VERSION, (self.refgene_path, self.mrna_path), lengths=list(self.LENGTHS))
+
+    def is_current(self) -> bool:
+        """
+        Checks if the index on disk was built by this version from the current sources.
+        """
+        return manifest_is_current(self.index_dir, self.manifest())
+
+    def build(self):
+        """
+        Translates the reference proteome and writes one sorted array of unique k-mer hashes per length.
+        Every file is written to a temporary file and renamed, the manifest last: a reader never maps a partial array
+        and the index only becomes current once it is complete.
+        """
+        logging.info(f"Building reference proteome k-mer index in {self.index_dir}...")
+        os.makedirs(self.index_dir, exist_ok=True)
+        manifest_file = os.path.join(self.index_dir, "manifest.json")
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        proteins = [protein for _, protein in reference_proteins(self.refgene_path, self.mrna_path)]
+        # One code array for the whole proteome, proteins separated by a 0 code
+        codes = _CODES[np.frombuffer("\0".join(proteins).encode("ascii", "replace"), dtype=np.uint8)]
+        logging.info(f"{len(proteins)} reference proteins translated ({len(codes)} residues).")
+        for k in self.LENGTHS:
+            kmer_file = os.path.join(self.index_dir, f"k{k}.npy")
+            with open(temp_path(kmer_file), "wb") as f:
+                np.save(f, np.unique(_kmer_hashes(codes, k)))
+            os.replace(temp_path(kmer_file), kmer_file)
+        with open(temp_path(manifest_file), "w") as f:
+            json.dump(self.manifest(), f)
+        os.replace(temp_path(manifest_file), manifest_file)
+        logging.info("Reference proteome k-mer index built.")
+
+    def load(self):
+        """
+        Maps the index (building it first if missing or outdated).
+        """
+        if self.kmers is None:
+            if not self.is_current():
+                self.build()
+            self.kmers = {
+                k: np.load(os.path.join(self.index_dir, f"k{k}.npy"), mmap_mode="r")
+                for k in self.LENGTHS
+            }
+        return self.kmers
+
+    def contains(self, peptides: list) -> np.ndarray:
+        """
+        Bulk query: boolean array, True for peptides that occur in the reference proteome.
+        """
+        kmers = self.load()
+        found = np.zeros(len(peptides), dtype=bool)
+        peptide_lengths = np.array([len(peptide) for peptide in peptides], dtype=np.int64)
+        for k in np.unique(peptide_lengths).tolist():
+            if k not in kmers or len(kmers[k]) == 0:
+                continue
+            rows = np.flatnonzero(peptide_lengths == k)
+            codes = _CODES[
+                np.frombuffer(
+                    "".join(peptides[i] for i in rows).encode("ascii", "replace"), dtype=np.uint8
+                )
+            ].reshape(len(rows), k)
+            multiplier = _multiplier(k)
+            hashes = np.zeros(len(rows), dtype=np.uint64)
+            for j in range(k):
+                hashes = hashes * multiplier + codes[:, j]
+            positions = np.minimum(np.searchsorted(kmers[k], hashes), len(kmers[k]) - 1)
+            found[rows] = (kmers[k][positions] == hashes) & (codes != 0).all(axis=1)
+        return found
@@ -15,13 +15,18 @@ class QCPipeline:
 
     def fastqc(self, file_list: list):
         """
-        Performs fastqc.
+        Performs fastqc, the files are submitted to the command_runner scheduler and checked concurrently.
         """
         path_to_reports = self.path_handler.output_subfolder("reports/fastqc")
         logging.info("Starting FastQC...")
-        for file in file_list:
-            self.command_runner.run(["fastqc", file[0], "-o", path_to_reports])
-        logging.info("FastQC completed.")
+        futures = {
+            file[1]: self.command_runner.submit(
+                ["fastqc", file[0], "-o", path_to_reports], label=file[1]
+            )
+            for file in file_list
+        }
+        succeeded, failed = self.command_runner.gather(futures)
+        logging.info(f"FastQC completed for {len(succeeded)} out of {len(file_list)} files.")
 
     def multiqc(self, folder: str):
         """
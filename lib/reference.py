@@ -0,0 +1,155 @@
+import os
+import json
+import logging
+
+# Standard genetic code, codons ordered TCAG x TCAG x TCAG
+_BASES = "TCAG"
+_AMINO_ACIDS = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+CODON_TABLE = {
+    a + b + c: _AMINO_ACIDS[16 * i + 4 * j + k]
+    for i, a in enumerate(_BASES)
+    for j, b in enumerate(_BASES)
+    for k, c in enumerate(_BASES)
+}
+
+
+def read_fasta(path: str):
+    """
+    Yields (header, sequence) for every record of a fasta file, header without '>'.
+    """
+    header, parts = None, []
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(parts)
+                header, parts = line[1:].strip(), []
+            else:
+                parts.append(line.strip())
+    if header is not None:
+        yield header, "".join(parts)
+
+
+def read_refgene_records(path: str):
+    """
+    Yields the records of the ANNOVAR refGene table (UCSC genePred with bin column), in file order.
+    """
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 11:
+                continue
+            try:
+                yield {
+                    "name": fields[1],
+                    "chrom": fields[2],
+                    "strand": fields[3],
+                    "tx_start": int(fields[4]),
+                    "tx_end": int(fields[5]),
+                    "cds_start": int(fields[6]),
+                    "cds_end": int(fields[7]),
+                    "exon_starts": [int(x) for x in fields[9].rstrip(",").split(",")],
+                    "exon_ends": [int(x) for x in fields[10].rstrip(",").split(",")],
+                    "gene": fields[12] if len(fields) > 12 else "",
+                }
+            except ValueError:
+                logging.warning(f"Ignoring refGene line with incorrect format: {line.strip()}")
+
+
+def read_refgene(path: str) -> dict:
+    """
+    Reads the ANNOVAR refGene table.
+    Returns {transcript name: [record, record2,...]}, a transcript can map to multiple loci.
+    """
+    transcripts = {}
+    for record in read_refgene_records(path):
+        transcripts.setdefault(record["name"], []).append(record)
+    return transcripts
+
+
+def find_refgene_record(transcripts: dict, mrna_id: str):
+    """
+    Finds the refGene record of an mRNA fasta id, either 'NM_...' or ANNOVAR's 'NM_...#chrom#txStart'.
+    Returns None (logged) if the locus matches no record, or if a transcript without locus maps to multiple loci
+    (e.g. PAR/alt copies), translating the CDS of another locus would put a wrong protein in the reference.
+    """
+    name, *locus = mrna_id.split("#")
+    records = transcripts.get(name)
+    if not records:
+        return None
+    if len(locus) == 2:
+        chrom, position = locus[0], int(locus[1])
+        for record in records:
+            if record["chrom"] == chrom and record["tx_start"] in (position, position - 1):
+                return record
+        logging.warning(f"Skipping {mrna_id}: no refGene record at its locus")
+        return None
+    if len(records) > 1:
+        logging.warning(f"Skipping {mrna_id}: maps to {len(records)} loci in refGene")
+        return None
+    return records[0]
+
+
+def cds_range(record: dict) -> tuple:
+    """
+    Start and end (exclusive) of the coding sequence within the mRNA (transcript orientation).
+    """
+    exons = list(zip(record["exon_starts"], record["exon_ends"]))
+    cds_start, cds_end = record["cds_start"], record["cds_end"]
+    cds_length = sum(max(0, min(end, cds_end) - max(start, cds_start)) for start, end in exons)
+    if record["strand"] == "+":
+        utr_length = sum(max(0, min(end, cds_start) - start) for start, end in exons)
+    else:
+        utr_length = sum(max(0, end - max(start, cds_end)) for start, end in exons)
+    return utr_length, utr_length + cds_length
+
+
+def translate(sequence: str, to_stop: bool = True) -> str:
+    """
+    Translates a coding DNA sequence, up to (not including) the first stop codon if to_stop.
+    Unknown codons become 'X'.
+    """
+    sequence = sequence.upper()
+    protein = []
+    for i in range(0, len(sequence) - 2, 3):
+        amino_acid = CODON_TABLE.get(sequence[i : i + 3], "X")
+        if amino_acid == "*" and to_stop:
+            break
+        protein.append(amino_acid)
+    return "".join(protein)
+
+
+def reference_proteins(refgene_path: str, mrna_path: str):
+    """
+    Yields (mRNA id, protein) for every coding transcript in the ANNOVAR refGeneMrna fasta.
+    """
+    transcripts = read_refgene(refgene_path)
+    for header, mrna in read_fasta(mrna_path):
+        mrna_id = header.split()[0]
+        record = find_refgene_record(transcripts, mrna_id)
+        if record is None or record["cds_start"] == record["cds_end"]:
+            continue  # non-coding or unknown transcript
+        start, end = cds_range(record)
+        yield mrna_id, translate(mrna[start:end])
+
+
+def source_manifest(version: int, sources: tuple, **fields) -> dict:
+    """
+    Manifest of an index built from reference files: version, extra build fields and (size, mtime) stamps of the sources.
+    """
+    return {
+        "version": version,
+        **fields,
+        "sources": {path: [os.path.getsize(path), int(os.path.getmtime(path))] for path in sources},
+    }
+
+
+def manifest_is_current(index_dir: str, manifest: dict) -> bool:
+    """
+    Checks if the manifest.json of an index on disk equals the manifest of the current version and sources.
+    """
+    manifest_file = os.path.join(index_dir, "manifest.json")
+    if not os.path.isfile(manifest_file):
+        return False
+    with open(manifest_file, "r") as f:
+        return json.load(f) == manifest
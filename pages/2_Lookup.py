@@ -1,9 +1,21 @@
+import os
+import re
 import streamlit as st
 import pandas as pd
 import plotly.express as px
+from lib.fasta_index import FastaIndex
 
 st.set_page_config(layout="wide")
 
+
+@st.cache_resource
+def load_fasta_index(output_path: str) -> FastaIndex:
+    """
+    One FastaIndex per output folder, kept over reruns so its sample map and index rows are read once.
+    """
+    return FastaIndex(output_path)
+
+
 # Check whether the results are ready
 if st.session_state.get("predictions") is None:
     st.header("Please run the pipeline first!")
@@ -54,6 +66,20 @@ else:
             else:
                 st.write(f"{column}: {value}")
 
+    # Source protein from the indexed coding_change fastas (sequence_name = sample_lineX_transcript(seqX))
+    match = re.match(r"^(.*)_(line\d+)_(.*?)(?:seq\d+)?$", str(selected_sequence))
+    if match:
+        fasta_index = load_fasta_index(os.path.dirname(os.path.abspath(file_path)))
+        mutant = fasta_index.fetch(*match.groups())
+        if mutant is not None:
+            st.subheader("Source protein")
+            st.write(mutant[0])
+            st.code(mutant[1], language=None)
+            wildtype = fasta_index.fetch(*match.groups(), wildtype=True)
+            if wildtype is not None:
+                st.write(wildtype[0])
+                st.code(wildtype[1], language=None)
+
     st.subheader("Legend")
     st.caption(
         "**Affinity (nM)**: *Lower values indicate stronger binders. Commonly-used threshold for peptides with a reasonable chance of being immunogenic is 500 nM.*"
@@ -1,12 +1,30 @@
 #!/usr/bin/env python
 
 ## EXTRACTING ALL THE .MAF FILES FROM THE GDC DOWNLOAD FOLDER
+## Deprecated: NeoLizard reads .maf.gz files directly and walks the GDC download folder recursively,
+## pass the download folder as --input (and use --m2a_workers to convert files in parallel,
+## or --m2a_split_samples for cohort MAFs).
 
 import os
+import sys
 import shutil
 import gzip
+import warnings
+
 
 def expand_tcga_mafs(source_dir:str,dest_dir:str)->None:
+    '''
+    Deprecated: copying and gunzipping the MAFs only costs disk space and I/O.
+    Still copies and gunzips every .maf.gz in source_dir (recursively) to dest_dir.
+    '''
+    # FutureWarning is shown by default, unlike DeprecationWarning
+    warnings.warn(
+        "expand_tcga_mafs is deprecated, pass the GDC download folder directly as --input to NeoLizard "
+        "(--m2a_split_samples for cohort MAFs).",
+        FutureWarning,
+        stacklevel=2,
+    )
+
     # Create the destination directory if it doesn't exist
     if not os.path.exists(dest_dir):
         os.makedirs(dest_dir)
@@ -22,7 +40,7 @@ def expand_tcga_mafs(source_dir:str,dest_dir:str)->None:
                 # Copy the file to the destination directory
                 shutil.copy2(source_file, destination_file)
 
-                print(f"Copied {file} to folder B")
+                print(f"Copied {file} to {dest_dir}")
 
                 # Gunzip the file
                 unzipped_file = os.path.splitext(destination_file)[0]  # Remove .gz extension
@@ -30,4 +48,15 @@ def expand_tcga_mafs(source_dir:str,dest_dir:str)->None:
                     with open(unzipped_file, 'wb') as f_out:
                         shutil.copyfileobj(f_in, f_out)
 
-                print(f"Gunzipped {file} in folder B")
\ No newline at end of file
+                print(f"Gunzipped {file} in {dest_dir}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        expand_tcga_mafs(sys.argv[1], sys.argv[2])
+    else:
+        print(
+            "TCGA MAF preparation is no longer needed: run NeoLizard with --input "
+            + (os.path.abspath(sys.argv[1]) if len(sys.argv) > 1 else "<GDC download folder>")
+            + " --m2a --m2a_workers 4"
+        )
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+## BENCHMARKING SERIAL VS PARALLEL CROPPING OF CODING_CHANGE FASTAS
+## Run from the NeoLizard dir: python scripts/benchmark_cropping.py
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib.path_handler import PathHandler
+from lib.cropping_flanks import CroppingFlanksPipeline
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def write_fasta(path: str, mutations: int, seed: int) -> None:
+    '''
+    Writes a coding_change-like fasta with a WILDTYPE and a mutant (SNP) record per mutation.
+    '''
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        for line in range(1, mutations + 1):
+            wildtype = "".join(rng.choice(AMINO_ACIDS) for _ in range(rng.randint(50, 800)))
+            pos = rng.randint(1, len(wildtype))
+            mutant = wildtype[: pos - 1] + rng.choice(AMINO_ACIDS) + wildtype[pos:]
+            transcript = f"NM_{rng.randint(1, 100000)}"
+            f.write(f">line{line} {transcript} WILDTYPE\n{wildtype}*\n")
+            f.write(
+                f">line{line} {transcript} c.{3 * pos}A>G p.{wildtype[pos - 1]}{pos}{mutant[pos - 1]} protein-altering\n{mutant}*\n"
+            )
+
+
+def synthetic_cohort(path: str, samples: int = 1000, mutations: int = 100) -> None:
+    '''
+    Creates a synthetic fastas directory with one file per sample.
+    '''
+    os.makedirs(path, exist_ok=True)
+    for sample in range(samples):
+        write_fasta(os.path.join(path, f"SAMPLE{sample:04d}.exonic_variant_function"), mutations, sample)
+
+
+def benchmark_cropping(samples: int = 1000, mutations: int = 100, workers=(1, 2, 4, 8), flank_length: int = 8) -> None:
+    '''
+    Times cropping_flanks_pipeline_run for growing worker counts and checks the results equal the serial path.
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        synthetic_cohort(path, samples, mutations)
+        reference = None
+        for amount in workers:
+            pipeline = CroppingFlanksPipeline(PathHandler(path, path), amount)
+            start = time.perf_counter()
+            result = pipeline.cropping_flanks_pipeline_run(flank_length)
+            elapsed = time.perf_counter() - start
+            if reference is None:
+                reference = result
+            print(f"{amount} workers: {len(result[0])} sequences of {samples} samples in {elapsed:.2f}s (identical: {result == reference})")
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    benchmark_cropping()
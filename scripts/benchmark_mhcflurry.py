@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+## BENCHMARKING THE BATCHED --add_flanks PREDICTION PATH AND PEPTIDE WINDOW MEMORY
+## Run from the NeoLizard dir: python scripts/benchmark_mhcflurry.py
+
+import os
+import sys
+import time
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib.MHCflurry_prediction import MHCflurryPipeline, Class1PresentationPredictor
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def random_sequences(amount: int, length: int = 17, seed: int = 1) -> tuple:
+    '''
+    Creates cropped sequences and flanks as returned by the cropping_flanks pipeline.
+    '''
+    rng = random.Random(seed)
+    sequences, flanks = [], []
+    for i in range(amount):
+        seq = "".join(rng.choice(AMINO_ACIDS) for _ in range(length))
+        sequences.append((f"sample{i % 50}_line{i}_NM_{i}", seq))
+        flanks.append(("".join(rng.choice(AMINO_ACIDS) for _ in range(20)), "".join(rng.choice(AMINO_ACIDS) for _ in range(20))))
+    return sequences, flanks
+
+
+def benchmark_add_flanks(sizes=(100, 1000, 10000), lengths=(9,)) -> None:
+    '''
+    Times the batched prediction for growing amounts of sequences, time per peptide should stay flat (linear scaling).
+    '''
+    predictor = Class1PresentationPredictor.load()
+    pipeline = MHCflurryPipeline(path_handler=None)
+    genotypes = [["HLA-A*02:01", "HLA-B*07:02"], ["HLA-A*31:01", "HLA-B*44:02"]]
+    for size in sizes:
+        sequences, flanks = random_sequences(size)
+        alleles = {name: genotypes[n % 2] for n, (name, _) in enumerate(sequences)}
+        start = time.perf_counter()
+        predictions = pipeline.predict_windows(predictor, sequences, flanks, list(lengths), alleles)
+        elapsed = time.perf_counter() - start
+        print(f"{len(predictions)} peptides: {elapsed:.2f}s ({1e6 * elapsed / len(predictions):.1f} us/peptide)")
+
+
+def materialized_flanks(sequences: list, flanks: list, lengths: list) -> tuple:
+    '''
+    Previous way of creating peptides: full flank strings for every window (O(L^2) per sequence).
+    '''
+    peptides, N_flanks, C_flanks = [], [], []
+    for count, (name, seq) in enumerate(sequences):
+        for l in lengths:
+            for index in range(len(seq) - l + 1):
+                peptides.append(seq[index : index + l])
+                N_flanks.append(flanks[count][0] + seq[:index])
+                C_flanks.append(seq[index:] + flanks[count][1])
+    return peptides, N_flanks, C_flanks
+
+
+def benchmark_window_memory(amount: int = 200, length: int = 400, lengths=(8, 9, 10, 11), flank_length: int = 10) -> None:
+    '''
+    Compares peak memory of fully materialized flanks with the window table and capped flanks (long frameshift products).
+    '''
+    sequences, flanks = random_sequences(amount, length)
+    pipeline = MHCflurryPipeline(path_handler=None)
+
+    tracemalloc.start()
+    materialized_flanks(sequences, flanks, list(lengths))
+    full_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    windows = pipeline.create_windows(sequences, list(lengths))
+    # Strings are materialized window by window, only the unique units are kept
+    genotypes = [("HLA-A*02:01",)] * len(sequences)
+    pipeline.plan_units(
+        pipeline.window_units(windows, flanks, genotypes, flank_length, flank_length), len(windows["start"])
+    )
+    window_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f"{len(windows['start'])} windows: materialized flanks {full_peak / 2**20:.1f} MiB, window table {window_peak / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    benchmark_window_memory()
+    benchmark_add_flanks()
@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+from lib.path_handler import PathHandler
+from lib.coding_change import CodingChangeEngine
+from lib.cropping_flanks import CroppingFlanksPipeline
+from lib.reference import read_fasta
+
+# 5'UTR GGG, CDS ATG AAA CCC GGG TTT TAA (M K P G F *), 3'UTR CCC TAG AAA
+MRNA = "GGGATGAAACCCGGGTTTTAACCCTAGAAA"
+# NM_1 on chr1 (+), NM_2 on chr2 (-) and a second NM_1 locus on chrX with P3S
+REFGENE = (
+    "0\tNM_1\tchr1\t+\t100\t130\t103\t121\t1\t100,\t130,\tG1\n"
+    "0\tNM_2\tchr2\t-\t500\t530\t509\t527\t1\t500,\t530,\tG2\n"
+    "0\tNM_1\tchrX\t+\t900\t930\t903\t921\t1\t900,\t930,\tG1\n"
+)
+MRNA_FASTA = (
+    f">NM_1#chr1#101 comment\n{MRNA[:15]}\n{MRNA[15:]}\n"
+    f">NM_2#chr2#501\n{MRNA}\n"
+    f">NM_1#chrX#901\n{MRNA.replace('AAACCC', 'AAATCC')}\n"
+)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    (tmp_path / "refGene.txt").write_text(REFGENE)
+    (tmp_path / "mrna.fa").write_text(MRNA_FASTA)
+    engine = CodingChangeEngine(str(tmp_path / "refGene.txt"), str(tmp_path / "mrna.fa"), str(tmp_path / "index"))
+    engine.load()
+    yield engine
+    engine.close()
+
+
+@pytest.mark.parametrize(
+    "change, mutation, pos, length, sequence, notation",
+    [
+        ("c.A4G", "snp", 1, 0, "MEPGF", "K2E"),  # SNV
+        ("c.A4T", "snp", 1, 0, "M", "K2*"),  # stopgain
+        ("c.4_6del", "del", 1, 0, "MPGF", "K2del"),
+        ("c.6_7insGGG", "ins", 1, 1, "MKGPGF", "K2_P3insG"),
+        ("c.4_6delinsTGGTGG", "indel", 1, 2, "MWWPGF", "K2delinsWW"),
+        ("c.4_6dup", "ins", 1, 1, "MKKPGF", "K2_P3insK"),
+        ("c.4delA", "indel", 1, 8, "MNPGFNPR", "K2Nfs*8"),  # frameshift, translated into the 3'UTR
+        ("c.T16C", "ins", 4, 2, "MKPGFQP", "F5_*6insQP"),  # stoploss
+    ],
+)
+def test_protein_change(engine, change, mutation, pos, length, sequence, notation):
+    protein_change = engine.protein_change("line1", "NM_1", "chr1", 105, change)
+    assert tuple(protein_change) == ("line1", "NM_1", mutation, pos, length, sequence, "MKPGF")
+    header = engine.fasta_header(protein_change)
+    assert header == f"line1 NM_1 p.{notation} protein-altering"
+    # The header parses back to the same mutation, position and length when cropping
+    assert CroppingFlanksPipeline(None).parse_header(">" + header) == (mutation, pos, length)
+
+
+def test_protein_change_transcripts(engine):
+    # Synonymous change and unknown transcript
+    assert engine.protein_change("line1", "NM_1", "chr1", 105, "c.A6G") is None
+    assert engine.protein_change("line1", "NM_3", "chr1", 105, "c.A4G") is None
+    # Minus strand: c. positions are relative to the mRNA
+    assert engine.protein_change("line1", "NM_2", "chr2", 515, "c.A4G").sequence == "MEPGF"
+    # Transcript with several loci: the locus of the variant
+    assert engine.protein_change("line1", "NM_1", "chrX", 905, "c.A4G").sequence == "MESGF"
+
+
+def test_run_pipeline(engine, tmp_path):
+    os.makedirs(tmp_path / "annovar")
+    variants = [
+        "line1\tnonsynonymous SNV\tG1:NM_1:exon1:c.A4G:p.K2E,G2:NM_2:exon1:c.A4G:p.K2E,\tchr1\t105\t105\tA\tG\t",
+        "line2\tsynonymous SNV\tG1:NM_1:exon1:c.A6G:p.K2K,\tchr1\t107\t107\tA\tG\t",
+        "line3\tframeshift deletion\tG1:NM_1:exon1:c.4delA:p.K2fs,\tchr1\t105\t105\tA\t-\t",
+        "line4\tstopgain\tG1:NM_1:exon1:c.A4T:p.K2X,\tchr1\t105\t105\tA\tT\t",
+        "line5\tstoploss\tG1:NM_1:exon1:c.T16C:p.X6Q,\tchr1\t117\t117\tT\tC\t",
+    ]
+    (tmp_path / "annovar" / "S1.exonic_variant_function").write_text("\n".join(variants) + "\n")
+    pathing = PathHandler(str(tmp_path / "annovar"), str(tmp_path / "output"))
+
+    protein_changes = engine.run_pipeline(pathing)
+
+    changes = protein_changes["S1"]
+    assert [(change.lineX, change.transcript) for change in changes] == [
+        ("line1", "NM_1"), ("line1", "NM_2"), ("line3", "NM_1"), ("line4", "NM_1"), ("line5", "NM_1")
+    ]
+    # coding_change.pl style fasta, the /fastas dir is the new input
+    fasta = tmp_path / "output" / "fastas" / "S1.exonic_variant_function"
+    assert pathing.input_path == str(tmp_path / "output" / "fastas")
+    records = list(read_fasta(str(fasta)))
+    assert records[:2] == [
+        ("line1 NM_1 WILDTYPE", "MKPGF*"),
+        ("line1 NM_1 p.K2E protein-altering", "MEPGF*"),
+    ]
+    assert all(sequence.endswith("*") for _, sequence in records)
+    # Cropping reads the same ProteinChanges back from the fasta (first transcript per lineX)
+    first = [change for i, change in enumerate(changes) if i == 0 or change.lineX != changes[i - 1].lineX]
+    assert list(CroppingFlanksPipeline(pathing).fasta_protein_changes(str(fasta), True)) == first
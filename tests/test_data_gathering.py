@@ -0,0 +1,61 @@
+import os
+
+from lib.path_handler import PathHandler
+from lib.data_gathering import PipelineData
+
+
+def write_fastas(folder, transcripts):
+    """
+    Writes a coding_change style fasta per sample: {sample: [(lineX, transcript),...]}.
+    """
+    os.makedirs(folder, exist_ok=True)
+    for sample, rows in transcripts.items():
+        with open(os.path.join(folder, sample + ".fasta"), "w") as f:
+            for lineX, transcript in rows:
+                f.write(f">{lineX} {transcript} WILDTYPE\nMAAAK\n")
+
+
+def run(tmp_path, transcripts, sample_filter=None):
+    """
+    One invocation: m2a (mutations + alleles) and coding_change linking, saving after each step like the CLI.
+    """
+    fastas = str(tmp_path / "input")
+    write_fastas(fastas, transcripts)
+    pathing = PathHandler(fastas, str(tmp_path / "output"))
+    pathing.sample_filter = sample_filter
+    pipeline_data = PipelineData(pathing)
+    pipeline_data.set_mutation_counts({sample: len(rows) for sample, rows in transcripts.items()})
+    pipeline_data.sample_alleles = {sample: ["HLA-A*02:01"] for sample in transcripts}
+    pipeline_data.save()
+    pipeline_data.link_mutation_to_transcripts()
+    pipeline_data.link_transcript_to_TCGA_HLA_alleles()
+    pipeline_data.save()
+
+
+def test_incremental_run_keeps_unselected_samples(tmp_path):
+    os.makedirs(tmp_path / "output")
+    run(tmp_path, {"A": [("line1", "NM_A")], "B": [("line1", "NM_B"), ("line2", "NM_B2")]})
+    os.remove(tmp_path / "input" / "A.fasta")
+    os.remove(tmp_path / "input" / "B.fasta")
+    run(tmp_path, {"C": [("line1", "NM_1")]}, sample_filter={"C"})
+
+    pipeline_data = PipelineData(PathHandler(str(tmp_path / "input"), str(tmp_path / "output")))
+    assert pipeline_data.mutation_transcripts == {
+        "A_line1": ["NM_A"],
+        "B_line1": ["NM_B"],
+        "B_line2": ["NM_B2"],
+        "C_line1": ["NM_1"],
+    }
+    assert pipeline_data.sample_mutations == {"A": ["line1"], "B": ["line1", "line2"], "C": ["line1"]}
+    assert dict(pipeline_data.transcripts_alleles) == {
+        name: ["HLA-A*02:01"] for name in ("A_line1_NM_A", "B_line1_NM_B", "B_line2_NM_B2", "C_line1_NM_1")
+    }
+
+
+def test_incremental_run_replaces_selected_samples(tmp_path):
+    os.makedirs(tmp_path / "output")
+    run(tmp_path, {"A": [("line1", "NM_A")], "B": [("line1", "NM_B")]})
+    run(tmp_path, {"B": [("line1", "NM_B3")]}, sample_filter={"B"})
+
+    pipeline_data = PipelineData(PathHandler(str(tmp_path / "input"), str(tmp_path / "output")))
+    assert pipeline_data.mutation_transcripts == {"A_line1": ["NM_A"], "B_line1": ["NM_B3"]}
@@ -0,0 +1,88 @@
+import os
+
+import pandas as pd
+
+from lib.path_handler import PathHandler
+from lib.incremental import IncrementalManifest
+from lib.m2a import MAFtoAVInputConverter
+from lib.file_utils import mark_complete
+
+MAF_HEADER = "Chromosome\tStart_Position\tEnd_Position\tReference_Allele\tTumor_Seq_Allele1\tTumor_Seq_Allele2\tTumor_Sample_Barcode\n"
+
+
+def write_maf(path, barcodes):
+    with open(path, "w") as f:
+        f.write("#version 2.4\n" + MAF_HEADER)
+        for position, barcode in enumerate(barcodes, start=100):
+            f.write(f"chr1\t{position}\t{position}\tA\tA\tG\t{barcode}\n")
+
+
+def write_predictions(path, samples, complete=True):
+    pd.DataFrame(
+        {"sequence_name": [sample + "_line1_NM_1" for sample in samples], "peptide": ["AAAAAAAAA"] * len(samples)}
+    ).to_csv(path, index=False)
+    if complete:
+        mark_complete(path)
+
+
+def run(tmp_path, complete=True):
+    """
+    One incremental --m2a --m2a_split_samples --mhcflurry run, as in the CLI.
+    Returns the samples that went through the pipeline, or None if nothing changed.
+    """
+    pathing = PathHandler(str(tmp_path / "input"), str(tmp_path / "output"))
+    manifest = IncrementalManifest(pathing)
+    pathing.sample_filter = manifest.changed_samples()
+    if not pathing.sample_filter:
+        manifest.save()
+        return None
+    m2a_pipeline = MAFtoAVInputConverter(pathing, split_samples=True)
+    m2a_pipeline.run_pipeline()
+    manifest.add_derived_samples(m2a_pipeline.split_sources)
+    # Predictions of the selected (split) samples
+    manifest.stash_predictions()
+    samples = sorted(sample for sample in pathing.sample_filter if sample.startswith("TCGA"))
+    write_predictions(os.path.join(pathing.main_output_path, "predictions.csv"), samples, complete)
+    manifest.merge_predictions()
+    manifest.save()
+    return samples
+
+
+def predicted_samples(tmp_path):
+    predictions = pd.read_csv(tmp_path / "output" / "predictions.csv")
+    return sorted(name.split("_line")[0] for name in predictions["sequence_name"])
+
+
+def test_incremental_split_samples(tmp_path):
+    os.makedirs(tmp_path / "input")
+    os.makedirs(tmp_path / "output")
+    write_maf(tmp_path / "input" / "cohort1.maf", ["TCGA-A", "TCGA-B"])
+    write_maf(tmp_path / "input" / "cohort2.maf", ["TCGA-C"])
+
+    assert run(tmp_path) == ["TCGA-A", "TCGA-B", "TCGA-C"]
+    manifest = IncrementalManifest(PathHandler(str(tmp_path / "input"), str(tmp_path / "output")))
+    # Only the real input samples are recorded, the barcodes as their outputs
+    assert sorted(manifest.samples) == ["cohort1", "cohort2"]
+    assert manifest.samples["cohort1"]["derived"] == ["TCGA-A", "TCGA-B"]
+    assert "avinput_files/TCGA-A.avinput" in manifest.samples["cohort1"]["outputs"]
+
+    # Nothing changed
+    assert run(tmp_path) is None
+
+    # A removed split output reprocesses its cohort MAF only
+    os.remove(tmp_path / "output" / "avinput_files" / "TCGA-C.avinput")
+    assert run(tmp_path) == ["TCGA-C"]
+
+    # Changed cohort MAF: the predictions of its barcodes, including the dropped TCGA-B, are replaced
+    write_maf(tmp_path / "input" / "cohort1.maf", ["TCGA-A", "TCGA-D"])
+    assert run(tmp_path) == ["TCGA-A", "TCGA-D"]
+    assert predicted_samples(tmp_path) == ["TCGA-A", "TCGA-C", "TCGA-D"]
+
+    # Incomplete predictions (failed run) are kept aside, the previous predictions are restored
+    write_maf(tmp_path / "input" / "cohort2.maf", ["TCGA-C", "TCGA-E"])
+    assert run(tmp_path, complete=False) == ["TCGA-C", "TCGA-E"]
+    assert predicted_samples(tmp_path) == ["TCGA-A", "TCGA-C", "TCGA-D"]
+    assert os.path.isfile(tmp_path / "output" / "predictions.partial.csv")
+    # and the changed cohort MAF is processed again
+    assert run(tmp_path) == ["TCGA-C", "TCGA-E"]
+    assert predicted_samples(tmp_path) == ["TCGA-A", "TCGA-C", "TCGA-D", "TCGA-E"]